@@ -4,10 +4,7 @@
 # https://charlesleifer.com/blog/how-to-make-a-flask-blog-in-one-hour-or-less/
 # but extended considerably by me.
 #
-# TODO: add tag management (delete, rename, etc)
-# TODO: change search algorithm
 # TODO: add separate section for recipes
-# TODO: add rss feed capability
 # TODO: verify uploaded file filetype
 
 
@@ -16,29 +13,46 @@
 # Imports
 ##################
 
+import concurrent.futures
 import datetime
+import email.utils
 import functools
+import gzip
+import hashlib
+import importlib
+import io
+import itertools
+import json
+import math
+import mimetypes
 import os
 import re
+import shutil
+import tarfile
+import threading
+import time
 import urllib
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from xml.sax.saxutils import escape as xml_escape
 
-from flask import (Flask, abort, flash, Markup, redirect, render_template,
-                   request, Response, session, url_for)
+import click
+from flask import (Flask, abort, flash, g, has_request_context, Markup,
+                   redirect, render_template, request, Response,
+                   send_from_directory, session, stream_with_context, url_for)
 
-# used for rendering the article body
-from markdown import markdown
-from markdown.extensions.codehilite import CodeHiliteExtension
-from markdown.extensions.extra import ExtraExtension
-
-# micawber supplies a few methods for retrieving rich metadata about a variety of links, such as links to youtube videos
-from micawber import bootstrap_basic, parse_html
-from micawber.cache import Cache as OEmbedCache
+# markdown, pygments and micawber are used for rendering the article body,
+# they are imported when the first entry is rendered, see Renderer
 
 # peewee and the playhoouse extensions deal with database management
 from peewee import *
 from playhouse.flask_utils import FlaskDB, get_object_or_404, object_list
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.sqlite_ext import *
 
+from werkzeug.http import is_resource_modified
+
 from secret import *
 
 
@@ -53,7 +67,42 @@ from secret import *
 # __file__ - prints out the file location
 APP_DIR = os.path.dirname(os.path.realpath(__file__))
 
-DATABASE = 'sqliteext:///%s' % os.path.join(APP_DIR, 'blog.db')
+DATABASE_PATH = os.path.join(APP_DIR, 'blog.db')
+
+# from https://www.sqlite.org/pragma.html, set on every connection
+# journal_mode -- write-ahead logging lets readers carry on while something
+#   is being written, instead of waiting for it
+# synchronous -- NORMAL only syncs at checkpoints, which is still safe from
+#   corruption when using WAL
+# cache_size -- negative values are in KiB, so 64MB of page cache
+# mmap_size -- read the file through up to 256MB of memory mapping
+# busy_timeout -- milliseconds a write will wait on another write
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
+}
+
+# passed to FlaskDB, which creates the database from it
+# the pool keeps connections open between requests so they keep their page
+# cache, use 'playhouse.sqlite_ext.SqliteExtDatabase' as the engine to open a
+# new connection for every request instead
+# check_same_thread -- pooled connections can be used by any thread
+DATABASE = {
+    'name': DATABASE_PATH,
+    'engine': 'playhouse.pool.PooledSqliteExtDatabase',
+    'max_connections': 8,
+    'stale_timeout': 600,
+    'check_same_thread': False,
+    'pragmas': SQLITE_PRAGMAS,
+}
+
+# these routes only read from the database, so they get a connection that
+# opened blog.db read only and never has to wait on a write; set to () to
+# use the normal connection everywhere
+READ_ONLY_ENDPOINTS = ('index', 'detail', 'feed', 'sitemap', 'list_tags', 'tags_json')
 
 DEBUG = False
 
@@ -63,6 +112,116 @@ DEBUG = False
 
 SITE_WIDTH = 800
 
+# number of entries on each page of the index
+PAGINATE_BY = 20
+
+# used as the title of the atom and rss feeds
+SITE_NAME = "Tom's Blog"
+
+# the author of the atom feed, which atom requires (rss doesn't have one)
+SITE_AUTHOR = 'Tom'
+
+# number of entries in the atom and rss feeds
+FEED_SIZE = 20
+
+# an entry's page links the entries that share the most tags with it, see
+# RelatedEntry (run `flask related rebuild` after changing kept)
+# posts -- number of related entries shown, 0 to show none
+# kept -- number stored for each entry, more than are shown since drafts are
+#   stored but not shown
+RELATED_POSTS = 5
+RELATED_KEPT = 10
+
+# bm25 weights for the search index, a match in the title counts for more
+# than a match in the body
+# run `flask migrate` (or restart the app) after changing these
+SEARCH_TITLE_WEIGHT = 10.0
+SEARCH_CONTENT_WEIGHT = 1.0
+
+# options passed to CodeHiliteExtension when rendering the article body
+# css_class -- name of css class used for div
+CODEHILITE_CONFIG = {'linenums': True, 'css_class': 'highlight'}
+
+# rendered html is stored in the EntryRender table, bump this whenever
+# Entry.render_html changes in a way that should throw away every stored copy
+RENDERER_VERSION = 1
+
+# responses from oembed providers (youtube, vimeo, etc.) are stored in the
+# OEmbedResponse table, see OEmbedProviderRegistry
+# ttl -- seconds before `flask oembed refresh` fetches a response again
+# negative_ttl -- seconds before a failed request is tried again
+# size -- maximum number of stored responses, the oldest are dropped
+# offline -- never touch the network, every provider is replaced with a stand
+#   in that makes up a response (for tests and working offline)
+OEMBED_CACHE_TTL = 7 * 24 * 60 * 60
+OEMBED_NEGATIVE_TTL = 60 * 60
+OEMBED_CACHE_SIZE = 5000
+OEMBED_OFFLINE = False
+
+# highlighted code blocks are stored in the HighlightedBlock table and reused
+# whenever the same code is highlighted again with the same options, so
+# re-rendering an edited entry only highlights the blocks that changed
+# size -- maximum number of stored blocks, the least recently used are
+#   dropped after each render job; 0 highlights every block every time
+HIGHLIGHT_CACHE_SIZE = 10000
+
+# timings are collected for every request and served at /metrics, which
+# needs a logged in session or an `Authorization: Bearer <METRICS_TOKEN>`
+# header (set METRICS_TOKEN in secret.py for a scraper to use)
+# METRICS_TOKEN = 'secret'
+# server_timing -- also send the timings in a Server-Timing header
+SERVER_TIMING = False
+
+# whole pages served to logged out readers are kept in memory, see ResponseCache
+# size -- maximum number of pages kept, the least recently used are dropped
+# ttl -- seconds a page is kept even if nothing invalidates it
+# shared -- every process serving the blog keeps its own copy, so the pages
+#   one of them purges are recorded in the database for the others to drop
+#   (one query per request), see SharedResponseCache; only turn this off if
+#   a single process serves the blog and nothing else writes to it
+RESPONSE_CACHE_SIZE = 500
+RESPONSE_CACHE_TTL = 60 * 60
+RESPONSE_CACHE_SHARED = True
+
+# `flask assets build` writes a minified copy of each file under static/ with
+# a hash of its content in the name, plus .gz (and .br, if the brotli package
+# is installed) copies and a manifest.json; url_for('static') then links the
+# hashed copies, which browsers can keep for good since a changed file gets a
+# new name (restart the app after building)
+# dir -- where the copies go, relative to static/
+# max_age -- seconds browsers may keep a hashed copy without asking again
+ASSETS_DIR = 'build'
+ASSETS_MAX_AGE = 365 * 24 * 60 * 60
+
+# rendering, embed lookups and purging cached pages after an entry is saved
+# are done by background threads, see JobQueue, so saving returns straight away
+# workers -- threads per process, 0 runs each job inline as it is queued (for
+#   hosts like PythonAnywhere's uWSGI that don't run threads between requests)
+# max_attempts -- a failing job is tried this many times before it is marked failed
+# retry_delay -- seconds before the first retry, doubled for every retry after
+# poll_interval -- seconds between looking for jobs queued by another process
+#   or due for a retry
+# timeout -- seconds before a running job is assumed to have died with its
+#   process and is run again
+# history -- seconds finished jobs are kept so the uploader can poll them
+JOB_WORKERS = 2
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 10
+JOB_POLL_INTERVAL = 5
+JOB_TIMEOUT = 10 * 60
+JOB_HISTORY = 24 * 60 * 60
+
+# `flask freeze` writes the public pages (entries, the index, tags, feeds and
+# a sitemap) to a directory that nginx or a CDN can serve without the app, see
+# the Static Export section; later runs only redo the pages that changed
+# dir -- where the pages are written
+# base_url -- where the copy will be served from, for the links in the feeds
+#   and sitemap
+# workers -- processes rendering pages, None for one per cpu
+FREEZE_DIR = os.path.join(APP_DIR, 'site')
+FREEZE_BASE_URL = 'http://localhost/'
+FREEZE_WORKERS = None
+
 # user agent used by blog_entry_uploader.py
 UPLOADER_USER_AGENT = 'tommy/post-uploader'
 
@@ -73,6 +232,10 @@ app = Flask(__name__)
 # a bunch of specific methods
 app.config.from_object(__name__)
 
+# any of the above can be overridden by a python file named in the
+# BLOG_SETTINGS environment variable, e.g. to point at a different database
+app.config.from_envvar('BLOG_SETTINGS', silent=True)
+
 # from http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#flask-utils
 # The FlaskDB class is a wrapper for configuring and referencing a Peewee database from within a Flask application.
 # Don’t let its name fool you: it is not the same thing as a peewee database.
@@ -80,13 +243,692 @@ app.config.from_object(__name__)
 #    Dynamically create a Peewee database instance based on app config data.
 #    Create a base class from which all your application’s models will descend.
 #    Register hooks at the start and end of a request to handle opening and closing a database connection.
-flask_db = FlaskDB(app)
+# FlaskDB opens a connection before every request and closes it afterwards,
+# this also gives the READ_ONLY_ENDPOINTS the read only connection
+# the database itself is opened by configure_app, until then (and so that
+# create_app can swap it for another one) the models use a placeholder
+class BlogFlaskDB(FlaskDB):
+
+    def __init__(self, app):
+        super(BlogFlaskDB, self).__init__()
+        self.database = Proxy()
+        app.before_request(self.connect_db)
+        app.teardown_request(self.close_db)
+
+    def connect_db(self):
+        if request.endpoint in app.config['READ_ONLY_ENDPOINTS']:
+            read_database.connect()
+
+            # the models all use the main database, so its connection for
+            # this thread is pointed at the read only one until close_db
+            self.database._state.set_connection(read_database.connection())
+            g.read_only = True
+        else:
+            self.database.connect()
+
+    def close_db(self, exc):
+        if g.get('read_only'):
+            self.database._state.reset()
+            read_database.close()
+        elif not self.database.is_closed():
+            self.database.close()
+
+    # for the occasional write during a read only request, borrows a normal
+    # connection for the duration of the with block
+    @contextmanager
+    def writable(self):
+        if not read_only_request():
+            yield
+            return
+
+        read_connection = self.database._state.conn
+        self.database._state.reset()
+        try:
+            with self.database.connection_context():
+                yield
+        finally:
+            self.database._state.set_connection(read_connection)
+
+flask_db = BlogFlaskDB(app)
 database = flask_db.database
 
-# as far as I can tell this loads provider information into micawber for converting
-# to convert urls into embeddable content, I think micawber.Cache has basic stored
-# info about these providers?
-oembed_providers = bootstrap_basic(OEmbedCache())
+# creates the database described by a DATABASE style config, this doesn't
+# connect to it yet
+# read_only -- open it with mode=ro so it can't write, journal_mode is left
+#   out since it is stored in the file and needs a write to set
+def open_database(config, read_only=False):
+    config = dict(config)
+    (module, class_name) = config.pop('engine').rsplit('.', 1)
+    database_class = getattr(importlib.import_module(module), class_name)
+
+    if read_only:
+        config['name'] = 'file:%s?mode=ro' % urllib.parse.quote(config['name'])
+        config['uri'] = True
+        config['pragmas'] = dict(
+            (key, value) for (key, value) in config.get('pragmas', {}).items()
+            if key != 'journal_mode')
+
+    return database_class(config.pop('name'), **config)
+
+# the same file as database, see open_database and configure_app
+read_database = None
+
+def read_only_request():
+    return has_request_context() and g.get('read_only', False)
+
+
+##################
+# Caching
+##################
+
+# a response cache that never stores anything, other backends subclass this
+# every cached value is stored with a set of tags (e.g. 'index' or
+# 'entry:<slug>') so that a write can drop only the pages it affects
+class ResponseCache(object):
+
+    # called before every request, see sync_response_cache
+    def begin_request(self):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags=()):
+        pass
+
+    def delete_tags(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+# an in-process least recently used cache bounded by size and age
+class LRUResponseCache(ResponseCache):
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (expires, value, tags), ordered from least to most recently used
+        self._data = OrderedDict()
+
+        # tag -> set of keys stored with that tag
+        self._tags = {}
+
+        # flask may serve requests from several threads
+        self._lock = threading.Lock()
+
+        # counts the calls to delete_tags; a page rendered by a request that
+        # started before a purge may hold what was purged, so it isn't stored
+        self.purges = 0
+        self._request = threading.local()
+
+    def begin_request(self):
+        self._request.purges = self.purges
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value, tags = self._data[key]
+            except KeyError:
+                return None
+
+            if expires < time.time():
+                self._remove(key)
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            if getattr(self._request, 'purges', self.purges) != self.purges:
+                return
+
+            self._remove(key)
+            self._data[key] = (time.time() + self.ttl, value, frozenset(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._data) > self.max_size:
+                self._remove(next(iter(self._data)))
+
+    def delete_tags(self, tags):
+        with self._lock:
+            self.purges += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.purges += 1
+            self._data.clear()
+            self._tags.clear()
+
+    # must be called with the lock held
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+# an LRUResponseCache for when several processes (gunicorn workers, or a
+# command run next to the server) share the database: the tags each one
+# purges are also written to the CacheInvalidation table, and before every
+# request the others drop the tags written since they last looked
+class SharedResponseCache(LRUResponseCache):
+
+    def __init__(self, max_size, ttl):
+        super(SharedResponseCache, self).__init__(max_size, ttl)
+
+        # the id of the last CacheInvalidation row dropped from this copy,
+        # None until the first request
+        self.generation = None
+        self._sync_lock = threading.Lock()
+
+    def begin_request(self):
+        self.sync()
+        super(SharedResponseCache, self).begin_request()
+
+    # one query on the primary key, which finds nothing unless something
+    # was written since the last request
+    def sync(self):
+        with self._sync_lock:
+            if self.generation is None:
+                # nothing has been stored yet, so there's nothing to drop
+                self.generation = CacheInvalidation.latest()
+                return
+
+            invalidations = list(CacheInvalidation.since(self.generation))
+            if invalidations:
+                super(SharedResponseCache, self).delete_tags(
+                    set(tag for (_, tag) in invalidations))
+                self.generation = invalidations[-1][0]
+
+    def delete_tags(self, tags):
+        tags = list(tags)
+        super(SharedResponseCache, self).delete_tags(tags)
+        if tags:
+            CacheInvalidation.record(tags)
+
+# a SharedResponseCache (or an LRUResponseCache if RESPONSE_CACHE_SHARED is
+# off) unless RESPONSE_CACHE_SIZE is 0, see configure_app
+response_cache = ResponseCache()
+
+@app.before_request
+def sync_response_cache():
+    if request.endpoint != 'static':
+        response_cache.begin_request()
+
+# providers are only asked for embeds while this is set for the thread, which
+# is only while an entry is being saved or by the commands, so rendering a
+# page never waits on the network
+oembed_state = threading.local()
+
+@contextmanager
+def fetching_oembeds():
+    previous = getattr(oembed_state, 'fetch', False)
+    oembed_state.fetch = True
+    try:
+        yield
+    finally:
+        oembed_state.fetch = previous
+
+
+##################
+# Metrics
+##################
+
+# a prometheus style histogram, kept separately for each label value
+class Histogram(object):
+
+    def __init__(self, name, description, label, buckets):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+
+        # label value -> [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            if label_value not in self._values:
+                self._values[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            item = self._values[label_value]
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    item[0][i] += 1
+            item[1] += value
+            item[2] += 1
+
+    # the prometheus text format, see
+    # https://prometheus.io/docs/instrumenting/exposition_formats/
+    def expose(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for (label_value, (counts, total, count)) in sorted(self._values.items()):
+                label = '%s="%s"' % (self.label, label_value)
+                for (bound, bucket_count) in zip(self.buckets, counts):
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (self.name, label, bound, bucket_count))
+                lines.append('%s_bucket{%s,le="+Inf"} %s' % (self.name, label, count))
+                lines.append('%s_sum{%s} %s' % (self.name, label, total))
+                lines.append('%s_count{%s} %s' % (self.name, label, count))
+        return '\n'.join(lines) + '\n'
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# these are per process, so each worker reports its own numbers
+request_seconds = Histogram(
+    'blog_request_duration_seconds', 'Time taken to handle a request.',
+    'endpoint', TIME_BUCKETS)
+request_queries = Histogram(
+    'blog_request_queries', 'SQL queries run while handling a request.',
+    'endpoint', QUERY_BUCKETS)
+request_query_seconds = Histogram(
+    'blog_request_query_duration_seconds', 'Time spent running SQL queries in a request.',
+    'endpoint', TIME_BUCKETS)
+stage_seconds = Histogram(
+    'blog_stage_duration_seconds', 'Time taken by each stage of rendering a page.',
+    'stage', TIME_BUCKETS)
+
+# running totals for the request being handled by this thread
+# totals -- stage name -> seconds, queries -- number of SQL queries
+stage_state = threading.local()
+
+def reset_stage_state():
+    stage_state.totals = {}
+    stage_state.queries = 0
+
+def stage_total(stage):
+    return getattr(stage_state, 'totals', {}).get(stage, 0.0)
+
+def record_stage(stage, elapsed):
+    stage_seconds.observe(stage, elapsed)
+    if not hasattr(stage_state, 'totals'):
+        reset_stage_state()
+    stage_state.totals[stage] = stage_state.totals.get(stage, 0.0) + elapsed
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+# every query goes through execute_sql, including the read only requests
+# (they use this database object with a different connection)
+# called by configure_app with the database behind the placeholder
+def instrument_database(db):
+    execute_sql = db.execute_sql
+
+    @functools.wraps(execute_sql)
+    def timed_execute_sql(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return execute_sql(*args, **kwargs)
+        finally:
+            if not hasattr(stage_state, 'totals'):
+                reset_stage_state()
+            stage_state.totals['db'] = stage_state.totals.get('db', 0.0) + time.perf_counter() - start
+            stage_state.queries += 1
+
+    db.execute_sql = timed_execute_sql
+
+# flask renders templates by calling Template.render
+class TimedTemplate(app.jinja_env.template_class):
+
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+app.jinja_env.template_class = TimedTemplate
+
+@app.before_request
+def start_request_timer():
+    reset_stage_state()
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_timings(response):
+    # missing if a before_request function that runs earlier (connect_db)
+    # raised, the error response is sent without any timings
+    request_start = g.get('request_start')
+    if request_start is None:
+        return response
+
+    elapsed = time.perf_counter() - request_start
+    endpoint = request.endpoint or 'none'
+    totals = stage_state.totals
+
+    request_seconds.observe(endpoint, elapsed)
+    request_queries.observe(endpoint, stage_state.queries)
+    request_query_seconds.observe(endpoint, totals.get('db', 0.0))
+
+    if app.config['SERVER_TIMING']:
+        timings = ['%s;dur=%.2f' % (stage, seconds * 1000)
+                   for (stage, seconds) in sorted(totals.items())]
+        timings.append('total;dur=%.2f;desc="%s queries"' % (elapsed * 1000, stage_state.queries))
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+    return response
+
+job_seconds = Histogram(
+    'blog_job_duration_seconds', 'Time taken to run a background job.',
+    'kind', TIME_BUCKETS)
+
+
+##################
+# Rendering
+##################
+
+# markdown, pygments and micawber (and beautifulsoup, which micawber uses)
+# take a good part of the startup time, and most processes never render an
+# entry since the html is stored, so they are only imported once something
+# is rendered; get_renderer returns the one Renderer for the process
+class Renderer(object):
+
+    def __init__(self):
+        # used for rendering the article body
+        from markdown import markdown
+        from markdown.extensions import codehilite
+        from markdown.extensions.codehilite import CodeHiliteExtension
+        from markdown.extensions.extra import ExtraExtension
+
+        # micawber supplies a few methods for retrieving rich metadata about a variety of links, such as links to youtube videos
+        from micawber import bootstrap_basic, parse_html
+        from micawber.exceptions import ProviderException, ProviderNotFoundException
+        from micawber.providers import Provider, ProviderRegistry, make_key
+
+        self.markdown = markdown
+        self.CodeHiliteExtension = CodeHiliteExtension
+        self.ExtraExtension = ExtraExtension
+        self.parse_html = parse_html
+        self.ProviderException = ProviderException
+
+        # every code block (fenced or indented) is highlighted by
+        # CodeHilite.hilite, which picks or guesses the lexer and runs pygments
+        # wrapping it times highlighting apart from the rest of the markdown
+        # conversion, and looks the block up in HighlightedBlock first, so an
+        # edited entry only has its changed blocks highlighted again
+        hilite = codehilite.CodeHilite.hilite
+
+        def cached_hilite(block, *args, **kwargs):
+            with timed('codehilite'):
+                if not app.config['HIGHLIGHT_CACHE_SIZE']:
+                    return hilite(block, *args, **kwargs)
+
+                key = highlight_key(block, args, kwargs)
+                html = HighlightedBlock.lookup(key)
+                if html is None:
+                    html = hilite(block, *args, **kwargs)
+                    HighlightedBlock.store(key, html)
+                return html
+
+        codehilite.CodeHilite.hilite = cached_hilite
+
+        # looks up oembed responses in the OEmbedResponse table instead of micawber's
+        # in-memory cache, which is lost on every restart and never stores failures
+        # outside of fetching_oembeds, expired responses are still used and a url
+        # that was never fetched is left as a plain link (and noted in
+        # oembed_state.missed, so the render isn't stored)
+        class OEmbedProviderRegistry(ProviderRegistry):
+
+            def request(self, url, **params):
+                provider = self.provider_for_url(url)
+                if provider is None:
+                    raise ProviderNotFoundException('Provider not found for "%s"' % url)
+
+                key = make_key(url, params)
+                fetch = getattr(oembed_state, 'fetch', False)
+
+                cached = OEmbedResponse.get_or_none(OEmbedResponse.key == key)
+                if cached is not None and (not fetch or cached.expires > datetime.datetime.now()):
+                    if cached.data is None:
+                        raise ProviderException('Cached failure for "%s"' % url)
+                    return json.loads(cached.data)
+
+                if not fetch:
+                    oembed_state.missed = True
+                    raise ProviderException('"%s" has not been fetched yet' % url)
+
+                try:
+                    data = provider.request(url, **params)
+                except ProviderException:
+                    OEmbedResponse.store(key, url, params, None)
+                    raise
+
+                OEmbedResponse.store(key, url, params, data)
+                return data
+
+        # answers every request without going anywhere, used when OEMBED_OFFLINE is set
+        class OfflineProvider(Provider):
+
+            def __init__(self):
+                super(OfflineProvider, self).__init__('http://localhost/oembed')
+
+            def request(self, url, **params):
+                return {
+                    'type': 'rich',
+                    'version': '1.0',
+                    'url': url,
+                    'title': url,
+                    'html': '<div class="oembed" data-url="%s"></div>' % str(Markup.escape(url)),
+                }
+
+        # as far as I can tell this loads provider information into micawber for converting
+        # to convert urls into embeddable content
+        self.oembed_providers = bootstrap_basic(registry=OEmbedProviderRegistry())
+
+        if app.config['OEMBED_OFFLINE']:
+            for (regex, _) in list(self.oembed_providers):
+                self.oembed_providers.register(regex, OfflineProvider())
+
+renderer = None
+renderer_lock = threading.Lock()
+
+def get_renderer():
+    global renderer
+    if renderer is None:
+        with renderer_lock:
+            if renderer is None:
+                renderer = Renderer()
+    return renderer
+
+# the versions of the rendering libraries, read from the installed packages
+# so that checking whether stored html is current doesn't import them
+@functools.lru_cache()
+def renderer_versions():
+    from importlib.metadata import version
+    return tuple(version(name) for name in ('Markdown', 'Pygments', 'micawber'))
+
+
+##################
+# Background Jobs
+##################
+
+# the work queued for an entry is kept in the Job table, so it survives a
+# restart and any process can pick it up; JobQueue runs it on a few threads
+# kind -> function called with the job's payload as keyword arguments
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def decorator(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+class JobQueue(object):
+
+    def __init__(self):
+        self._threads = []
+        self._lock = threading.Lock()
+
+        # set whenever a job is queued in this process, so an idle worker
+        # doesn't wait out the poll interval
+        self._pending = threading.Event()
+
+        # with JOB_WORKERS at 0, the ids of the jobs this thread queued inside
+        # a transaction, see run_deferred
+        self._deferred = threading.local()
+
+    # starts the worker threads, called on the first request and when the
+    # first job is queued
+    def start(self):
+        with self._lock:
+            if self._threads or not app.config['JOB_WORKERS']:
+                return
+            for i in range(app.config['JOB_WORKERS']):
+                thread = threading.Thread(
+                    target=self._work, name='job-worker-%s' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # queues a job and returns it, or returns the one that is already waiting
+    # to run with the same kind and payload (e.g. an entry saved twice in a row)
+    # a job queued inside a transaction is only seen by the workers once it is
+    # committed, call wake afterwards so they don't wait for the next poll
+    # with JOB_WORKERS at 0 the job is run here instead, straight away or, inside
+    # a transaction, by that call to wake (rendering and fetching embeds
+    # mustn't hold the write lock)
+    def enqueue(self, kind, **payload):
+        payload = json.dumps(payload, sort_keys=True)
+        key = '%s:%s' % (kind, payload)
+
+        with flask_db.writable():
+            job = Job.get_or_none(
+                (Job.key == key) & (Job.status == 'queued') &
+                (Job.run_after <= datetime.datetime.now()))
+            if job is None:
+                job = Job.create(kind=kind, key=key, payload=payload)
+
+        if not app.config['JOB_WORKERS']:
+            if not hasattr(self._deferred, 'job_ids'):
+                self._deferred.job_ids = []
+            self._deferred.job_ids.append(job.id)
+            if database.in_transaction():
+                return job
+            self.run_deferred()
+            return Job.get_by_id(job.id)
+
+        self.wake()
+        return job
+
+    # lets an idle worker know there is a job without waiting for its next poll
+    def wake(self):
+        if not app.config['JOB_WORKERS']:
+            self.run_deferred()
+            return
+        self.start()
+        self._pending.set()
+
+    # runs the jobs enqueue held back, once the transaction they were queued
+    # in has been committed
+    def run_deferred(self):
+        if database.in_transaction():
+            return
+        job_ids = getattr(self._deferred, 'job_ids', [])
+        while job_ids:
+            with flask_db.writable():
+                self.run_next(job_ids.pop(0))
+
+    # claims the next job that is due (or the given one) and runs it
+    # returns False if there was nothing to run
+    def run_next(self, job_id=None):
+        job = self.claim(job_id)
+        if job is None:
+            return False
+
+        start = time.perf_counter()
+        try:
+            JOB_HANDLERS[job.kind](**json.loads(job.payload))
+        except Exception as exc:
+            app.logger.exception('Job %s (%s) failed', job.id, job.kind)
+            now = datetime.datetime.now()
+            if job.attempts >= app.config['JOB_MAX_ATTEMPTS']:
+                changes = {'status': 'failed', 'finished_at': now}
+            else:
+                delay = app.config['JOB_RETRY_DELAY'] * 2 ** (job.attempts - 1)
+                changes = {'status': 'queued',
+                           'run_after': now + datetime.timedelta(seconds=delay)}
+            Job.update(error=repr(exc), **changes).where(Job.id == job.id).execute()
+        else:
+            (Job
+             .update(status='done', error=None, finished_at=datetime.datetime.now())
+             .where(Job.id == job.id)
+             .execute())
+            Job.prune(app.config['JOB_HISTORY'])
+        finally:
+            job_seconds.observe(job.kind, time.perf_counter() - start)
+
+        return True
+
+    # marks a job as running, if no other worker (in this or another process)
+    # got to it first; a job left running past JOB_TIMEOUT is taken over
+    def claim(self, job_id=None):
+        while True:
+            now = datetime.datetime.now()
+            timed_out = now - datetime.timedelta(seconds=app.config['JOB_TIMEOUT'])
+            query = (Job
+                     .select()
+                     .where(
+                         ((Job.status == 'queued') & (Job.run_after <= now)) |
+                         ((Job.status == 'running') & (Job.started_at <= timed_out)))
+                     .order_by(Job.run_after, Job.id))
+            if job_id is not None:
+                query = query.where(Job.id == job_id)
+
+            job = query.first()
+            if job is None:
+                return None
+
+            # attempts works as a version number, the update only matches if
+            # nobody claimed the job since it was selected
+            claimed = (Job
+                       .update(status='running', started_at=now,
+                               attempts=Job.attempts + 1)
+                       .where((Job.id == job.id) & (Job.attempts == job.attempts))
+                       .execute())
+            if claimed:
+                job.attempts += 1
+                return job
+
+    def _work(self):
+        while True:
+            self._pending.clear()
+            try:
+                with database.connection_context():
+                    ran = self.run_next()
+            except Exception:
+                app.logger.exception('Job worker error')
+                ran = False
+
+            if not ran:
+                self._pending.wait(app.config['JOB_POLL_INTERVAL'])
+
+job_queue = JobQueue()
+
+# jobs left over from the last run are picked up without waiting for a save,
+# once `flask migrate` has brought the tables up to date
+@app.before_first_request
+def start_job_workers():
+    with database.connection_context():
+        current = schema_is_current()
+    if not current:
+        app.logger.warning('The database is out of date, run `flask migrate`.')
+        return
+    job_queue.start()
 
 
 ##################
@@ -119,122 +961,250 @@ class Entry(flask_db.Model):
     published = BooleanField(index=True)
     timestamp = DateTimeField(default=datetime.datetime.now, index=True)
 
+    # timestamp only records when the entry was created, this is set on
+    # every save and is used for the ETag and Last-Modified headers
+    updated_at = DateTimeField(default=datetime.datetime.now, index=True)
+
     @property
     def html_content(self):
+        # the html is rendered and stored when the entry is saved, so this is
+        # normally a single lookup; a stale or missing copy is rebuilt here
+        # Markup returns a string that is ready to be safely inserted into
+        # an HTML document
+        return Markup(self.update_rendered_html())
+
+    # converts the markdown content into html, this is the expensive part of
+    # showing an entry so it should only be called by update_rendered_html
+    def render_html(self):
+
+        renderer = get_renderer()
 
         # used for code/syntax highlighting
-        # css_class -- name of css class used for div
-        hilite = CodeHiliteExtension(linenums=True, css_class='highlight')
+        hilite = renderer.CodeHiliteExtension(**app.config['CODEHILITE_CONFIG'])
 
         # all the extensions found here:
         # https://python-markdown.github.io/extensions/extra/
-        extras = ExtraExtension()
+        extras = renderer.ExtraExtension()
 
         # utilizes the above extensions and converts the markdown to html
-        markdown_content = markdown(self.content, extensions=[hilite, extras])
+        # highlighting is timed separately (see cached_hilite), so it is
+        # taken back out of the markdown time
+        highlight_before = stage_total('codehilite')
+        start = time.perf_counter()
+        markdown_content = renderer.markdown(self.content, extensions=[hilite, extras])
+        record_stage('markdown', time.perf_counter() - start -
+                     (stage_total('codehilite') - highlight_before))
 
         # parse_html -- Parse HTML intelligently, rendering items on their own
         # within block elements as full content (e.g. a video player)
         # urlize_all -- constructs a simple link when provider is not found
-        oembed_content = parse_html(
-            markdown_content,
-            oembed_providers,
-            urlize_all=True,
-            maxwidth=app.config['SITE_WIDTH'])
+        with timed('oembed'):
+            return renderer.parse_html(
+                markdown_content,
+                renderer.oembed_providers,
+                urlize_all=True,
+                maxwidth=app.config['SITE_WIDTH'])
+
+    # returns the stored html for this entry, rendering it again only if the
+    # content or the render settings have changed since it was stored
+    def update_rendered_html(self, force=False):
+        # only set again if this renders, so callers can check it either way
+        oembed_state.missed = False
+
+        content_hash = hash_content(self.content)
+        signature = render_signature()
 
-        # Markup returns a string that is ready to be safely inserted into
-        # an HTML document
-        return Markup(oembed_content)
+        try:
+            rendered = EntryRender.get(EntryRender.entry == self.id)
+        except EntryRender.DoesNotExist:
+            rendered = None
+
+        if (not force and rendered is not None and
+                rendered.content_hash == content_hash and
+                rendered.signature == signature):
+            return rendered.html
+
+        html = self.render_html()
+
+        # some embeds weren't available without fetching them, this copy is
+        # used once and the next save or `flask rerender` stores a full one
+        if oembed_state.missed:
+            return html
+
+        # INSERT OR REPLACE, so there is only ever one row per entry
+        with flask_db.writable():
+            (EntryRender
+             .insert(entry=self.id, content_hash=content_hash,
+                     signature=signature, html=html)
+             .on_conflict_replace()
+             .execute())
+
+        return html
 
     def save(self, *args, **kwargs):
-        # replace the non-URL-friendly characters and put that in self.slug
-        if not self.slug:
-            # \w     - matches any word character (alphanumeric & underscore)
-            # [^\w]  - matches anything not in the set
-            # [^\w]+ - matches one or more of the preceding
-            self.slug = re.sub('[^\w]+', '-', self.title.lower())
+        self.update_slug()
 
         self.update_summary()
 
+        self.updated_at = datetime.datetime.now()
+
         # this explicity puts the super() arguments Entry, self when you can
         # just say super()
         # saves the Entry instance into the database
+        # the search index is updated by triggers on the entry table (see
+        # SEARCH_TRIGGERS), so it is written in the same statement
         ret = super(Entry, self).save(*args, **kwargs)
 
-        # store search content
-        self.update_search_index()
+        # the html is rendered (and embedded links looked up) by a background
+        # job rather than here or on the next page view, see render_entry
+        # pages showing the old version are dropped now and again once the new
+        # html is stored
+        self.render_job = job_queue.enqueue('render', entry_id=self.id)
+
+        self.purge_cached_pages(self.get_tags())
 
         # returns number of rows modified
         return ret
 
+    # links the given tags to this entry, creating any that don't exist yet
     def add_tags(self, *args):
-        new_tag_count = 0
-        new_entrytag_count = 0
-        for t in args:
-            # returns a tuple of model instance and boolean showing whether or
-            # not the entry was created
-            (tag, tag_created) = Tag.get_or_create(title = t)
-
-            if tag_created:
-                new_tag_count += 1
-
-            (_, entrytag_created) = EntryTag.get_or_create(entry = self, tag = tag)
-
-            if entrytag_created:
-                new_entrytag_count += 1
+        (new_tag_count, new_entrytag_count, _) = self.update_tags(args, remove=False)
 
         # returning for basic debug
         return (new_tag_count, new_entrytag_count)
 
+    # makes the given tags the only ones linked to this entry
+    def set_tags(self, *args):
+        return self.update_tags(args, remove=True)
+
+    # works out which tags and links have to change with one query and then
+    # applies it with one statement per kind of change, all in one transaction
+    # remove -- also unlink tags that aren't given
+    # returns the number of tags created, links created and links removed
+    def update_tags(self, titles, remove):
+        titles = list(OrderedDict.fromkeys(
+            Tag.sanitize_query(t) for t in titles if t and t.strip()))
+
+        # IMMEDIATE takes the write lock before the first read, a transaction
+        # that reads first can't wait for a background job's write to finish
+        # (its snapshot would be out of date) and fails with "database is locked"
+        with database.atomic('IMMEDIATE'):
+            # the requested tags that exist and the tags linked to this entry,
+            # with whether each is linked
+            linked_tags = EntryTag.select(EntryTag.tag).where(EntryTag.entry == self.id)
+            query = (Tag
+                     .select(Tag.id, Tag.title, EntryTag.id.alias('link'))
+                     .join(EntryTag, JOIN.LEFT_OUTER,
+                           on=((EntryTag.tag == Tag.id) & (EntryTag.entry == self.id)))
+                     .where(Tag.title.in_(titles) | Tag.id.in_(linked_tags))
+                     .tuples())
+            existing = dict((title, (tag_id, link)) for (tag_id, title, link) in query)
+
+            new_titles = [t for t in titles if t not in existing]
+            to_link = [t for t in titles if not existing.get(t, (None, None))[1]]
+            to_unlink = []
+            if remove:
+                to_unlink = [t for (t, (_, link)) in existing.items()
+                             if link and t not in titles]
+
+            if new_titles:
+                (Tag
+                 .insert_many([{'title': t} for t in new_titles])
+                 .on_conflict_ignore()
+                 .execute())
+
+            if to_link:
+                (EntryTag
+                 .insert_from(
+                     Tag.select(Value(self.id), Tag.id).where(Tag.title.in_(to_link)),
+                     fields=[EntryTag.entry, EntryTag.tag])
+                 .on_conflict_ignore()
+                 .execute())
+
+            if to_unlink:
+                unlinked_ids = [existing[t][0] for t in to_unlink]
+                (EntryTag
+                 .delete()
+                 .where(
+                     (EntryTag.entry == self.id) &
+                     (EntryTag.tag.in_(unlinked_ids)))
+                 .execute())
+
+                # a tag that no entry has any more isn't kept around
+                Tag.delete_unused(unlinked_ids)
+
+        if to_link or to_unlink:
+            # the tags loaded with the entry (see with_tags) are out of date
+            self.__dict__.pop('tag_list', None)
+            self.purge_cached_pages(to_link + to_unlink)
+
+            # and so are the entries related to it, see update_related
+            self.related_job = job_queue.enqueue('related', entry_id=self.id)
+
+        return (len(new_titles), len(to_link), len(to_unlink))
+
     def get_tags(self):
+        # listing queries load the tags along with the entry (see with_tags),
+        # so only go back to the database if they weren't selected
+        if hasattr(self, 'tag_list'):
+            return self.tag_list.split(',') if self.tag_list else []
+
         try:
-            tags = [tag.tag.title for tag in self.tags]
+            tags = [tag.title for tag in (Tag
+                                          .select(Tag.title)
+                                          .join(EntryTag)
+                                          .where(EntryTag.entry == self.id)
+                                          .order_by(EntryTag.id))]
         except:
             tags = []
         finally:
             return tags
 
+    # drops the cached pages that show this entry: its own page, the index
+    # and search pages, and the pages for the given tags
+    def purge_cached_pages(self, tags=()):
+        keys = ['index', 'entry:%s' % self.slug]
+        keys.extend('tag:%s' % tag for tag in tags)
+        response_cache.delete_tags(keys)
+
+    # replace the non-URL-friendly characters and put that in self.slug
+    def update_slug(self):
+        if not self.slug:
+            # \w     - matches any word character (alphanumeric & underscore)
+            # [^\w]  - matches anything not in the set
+            # [^\w]+ - matches one or more of the preceding
+            self.slug = re.sub('[^\w]+', '-', self.title.lower())
+
     # creates a basic 100 character summary
     def update_summary(self):
         matches = re.findall('[A-Za-z\s\,\.]+[^<*>]\w+', self.content[:200])
-        print(matches)
         match = " ".join(matches)
         self.summary = match[:100]
 
-    # updates the FTSEntry table used for fast searching of all articles
-    def update_search_index(self):
-
-        search_content = '\n'.join((self.title, self.content))
-
-        # check to see if there's already an FTSEntry for this article
-        try:
-            fts_entry = FTSEntry.get(FTSEntry.docid == self.id)
-
-        # if there's not one, create it
-        except FTSEntry.DoesNotExist:
-            # previously this had docid instead of rowid, but this (http://docs.peewee-orm.com/en/latest/peewee/sqlite_ext.html#FTSModel)
-            # there is an automatically created rowid
-            FTSEntry.create(rowid = self.id, content=search_content)
-
-        # if there is one, update the contents and save
-        else:
-            fts_entry.content = search_content
-            fts_entry.save()
-
     # wrapper for super delete_instance
     def delete_instance(self, *args, **kwargs):
 
-        ret = super(Entry, self).delete_instance(*args, **kwargs)
+        tags = self.get_tags()
 
-        self.delete_search_index()
+        # the search index row is removed by a trigger
+        with database.atomic('IMMEDIATE'):
+            tag_ids = [tag_id for (tag_id,) in (EntryTag
+                                                .select(EntryTag.tag)
+                                                .where(EntryTag.entry == self.id)
+                                                .tuples())]
 
-        return ret
+            ret = super(Entry, self).delete_instance(*args, **kwargs)
 
-    def delete_search_index(self):
+            EntryRender.delete().where(EntryRender.entry == self.id).execute()
+            EntryTag.delete().where(EntryTag.entry == self.id).execute()
+            Tag.delete_unused(tag_ids)
 
-        fts_entry = FTSEntry.get(FTSEntry.docid == self.id)
+        # takes it out of the other entries' related lists
+        job_queue.enqueue('related', entry_id=self.id)
 
-        fts_entry.delete_instance()
+        self.purge_cached_pages(tags)
+
+        return ret
 
     # Class methods are like instance methods, except that instead of the instance
     # of an object being passed as the first positional self argument, the class
@@ -246,6 +1216,82 @@ class Entry(flask_db.Model):
     # - It can modify a class state that would apply across all the instances of the
     # class. For example, it can modify a class variable that would be applicable
     # to all the instances.
+    # inserts many unsaved entries and their tags in one transaction with a
+    # handful of bulk INSERTs, instead of the queries save and add_tags run
+    # for every entry; the search index is filled in by its triggers and the
+    # html is rendered by background jobs queued once the entries are committed
+    # entries -- a list of (entry, tags) pairs, the slugs must be free
+    @classmethod
+    def import_many(cls, entries):
+        now = datetime.datetime.now()
+        rows = []
+        for (entry, _) in entries:
+            entry.update_slug()
+            entry.update_summary()
+            entry.updated_at = now
+            rows.append(dict(entry.__data__))
+
+        tag_titles = set()
+        for (_, tags) in entries:
+            tag_titles.update(Tag.sanitize_query(t) for t in tags if t)
+
+        with database.atomic('IMMEDIATE'):
+            # sqlite limits the number of variables in one statement
+            for batch in chunked(rows, 100):
+                Entry.insert_many(batch).execute()
+
+            for batch in chunked([{'title': t} for t in tag_titles], 100):
+                Tag.insert_many(batch).on_conflict_ignore().execute()
+
+            entry_ids = {}
+            tag_ids = {}
+            for batch in chunked([e.slug for (e, _) in entries], 500):
+                query = Entry.select(Entry.id, Entry.slug).where(Entry.slug.in_(batch))
+                entry_ids.update((e.slug, e.id) for e in query)
+            for batch in chunked(list(tag_titles), 500):
+                query = Tag.select(Tag.id, Tag.title).where(Tag.title.in_(batch))
+                tag_ids.update((t.title, t.id) for t in query)
+
+            links = set()
+            for (entry, tags) in entries:
+                entry.id = entry_ids[entry.slug]
+                for t in tags:
+                    if t:
+                        links.add((entry.id, tag_ids[Tag.sanitize_query(t)]))
+
+            for batch in chunked(sorted(links), 100):
+                (EntryTag
+                 .insert_many(batch, fields=[EntryTag.entry, EntryTag.tag])
+                 .execute())
+
+        response_cache.delete_tags(['index'] + ['tag:%s' % t for t in tag_titles])
+
+        with database.atomic('IMMEDIATE'):
+            for (entry, tags) in entries:
+                entry.render_job = job_queue.enqueue('render', entry_id=entry.id)
+                if any(tags):
+                    entry.related_job = job_queue.enqueue('related', entry_id=entry.id)
+        job_queue.wake()
+
+        return [entry for (entry, _) in entries]
+
+    # adds a comma separated tag_list column to an entry query, so that a page
+    # of entries and their tags is loaded in one query instead of one query
+    # per entry and another per tag
+    # the list is kept up to date in EntryCard, so this is a lookup by key
+    @classmethod
+    def with_tags(cls, query):
+        tag_list = (EntryCard
+                    .select(EntryCard.tag_list)
+                    .where(EntryCard.entry == Entry.id))
+        return query.select_extend(tag_list.alias('tag_list'))
+
+    # published (or draft) entries for a listing, read from EntryCard so that
+    # none of the content is loaded; see EntryCard.listing
+    @classmethod
+    def cards(cls, published=True):
+        return EntryCard.listing().where(EntryCard.published == published)
+
     @classmethod
     def public(cls):
         return Entry.select().where(Entry.published == True)
@@ -254,31 +1300,44 @@ class Entry(flask_db.Model):
     def drafts(cls):
         return Entry.select().where(Entry.published == False)
 
+    # the number of published entries and of drafts, read from EntryCount
+    @classmethod
+    def public_count(cls):
+        return EntryCount.total(published=True)
+
+    @classmethod
+    def draft_count(cls):
+        return EntryCount.total(published=False)
+
     @classmethod
     def search(cls, query):
-        # not sure why the if statement is the same as the expression,
-        # this may be open for simplification (TODO)
-        words = [word.strip() for word in query.split() if word.strip()]
-        if not words:
+        search = fts_query(query)
+        if not search:
             # return empty query
             return Entry.select().where(Entry.id == 0)
-        else:
-            search = ' '.join(words)
 
-        # select -- selects all columns on Entry, and a score (the alias) to
-        # the rank of each entry in matching the search string
-        # .match - Generate a SQL expression representing a search for the given term or expression in the table.
-        # order_by(SQL('score')) -- when using aliases, you must call them using
-        # SQL(), which is a helper function that runs arbitrary SQL
+        # snippet -- a short extract of the best matching column with the
+        # matched terms wrapped in the markers, see highlight_snippet
+        snippet = fn.snippet(
+            FTSEntry._meta.entity, -1,
+            SNIPPET_START, SNIPPET_END, '\u2026', 24)
+
+        # the search starts from the FTS table and orders by its hidden rank
+        # column, which FTS5 can hand back already sorted, so sqlite looks up
+        # entries one at a time and stops once it has a page instead of
+        # sorting every match
+        # rank is bm25 with the title and content weights, see migrate_database
         # NOTE: check this specification out for more info on what is supported
-        # with match - http://sqlite.org/fts3.html#section_3
+        # with match - https://sqlite.org/fts5.html#full_text_query_syntax
+        # only the columns a listing shows, the content can be large
         return (Entry
-                .select(Entry, FTSEntry.rank().alias('score'))
-                .join(FTSEntry, on=(Entry.id == FTSEntry.docid))
+                .select(Entry.id, Entry.title, Entry.slug, Entry.summary,
+                        Entry.published, Entry.timestamp, snippet.alias('snippet'))
+                .join(FTSEntry, on=(Entry.id == FTSEntry.rowid))
                 .where(
                     (Entry.published == True) &
                     (FTSEntry.match(search)))
-                .order_by(SQL('score')))
+                .order_by(FTSEntry.rank()))
 
 # FTS stands for Full Text Search, which is an extension of SQLite's virtual
 # table functionality
@@ -287,15 +1346,240 @@ class Entry(flask_db.Model):
 # object looks like a table, but does not actually read or write to the database
 # file, instead it could represent in-memory data structures or data on disk that
 # is not in the SQLite database format
-class FTSEntry(FTSModel):
+# FTS5 ranks matches with bm25 and can weight each column separately, so the
+# title and the body are stored in their own columns
+# this is an "external content" table: the text itself is read from the entry
+# table and only the index is stored here, which triggers keep up to date
+# from https://sqlite.org/fts5.html#external_content_tables
+class FTSEntry(FTS5Model):
 
     # only for use in full-text search virtual tables
+    # these have to have the same names as the columns on Entry
+    title = SearchField()
     content = SearchField()
 
     # some kind of strange thing peewee does to relate a database to the
     # class without using the above method in the class inheritance field
+    # porter -- stems words before indexing them, so "onion" matches "onions"
     class Meta:
         database = database
+        options = {
+            'content': Entry,
+            'content_rowid': Entry.id,
+            'tokenize': 'porter unicode61'}
+
+    # builds the whole index again from the entry table, much faster than
+    # going through the triggers for every entry after a large import
+    @classmethod
+    def rebuild(cls):
+        return cls._fts_cmd('rebuild')
+
+    # merges the index into a single b-tree, which makes searches faster
+    @classmethod
+    def optimize(cls):
+        return cls._fts_cmd('optimize')
+
+    # compares the index with what it would be if it was built from the entry
+    # table right now and returns two lists of entry ids:
+    # missing -- entries that aren't in the index at all
+    # stale -- entries indexed with old text, or deleted but still indexed
+    # the text is tokenized into a temporary table with the same tokenizer and
+    # the two are compared token by token through fts5vocab tables
+    @classmethod
+    def check(cls):
+        tokenize = cls._meta.options['tokenize']
+        statements = (
+            "CREATE VIRTUAL TABLE temp.ftsentry_expected USING fts5 "
+            "(title, content, tokenize='%s')" % tokenize,
+            "CREATE VIRTUAL TABLE temp.ftsentry_expected_vocab USING fts5vocab "
+            "(temp, ftsentry_expected, instance)",
+            "CREATE VIRTUAL TABLE temp.ftsentry_vocab USING fts5vocab "
+            "(main, ftsentry, instance)",
+            "INSERT INTO temp.ftsentry_expected (rowid, title, content) "
+            "SELECT id, title, content FROM entry")
+
+        # rows that are in one index but not the other
+        difference = ("SELECT DISTINCT doc FROM ("
+                      "SELECT term, doc, col, offset FROM temp.%s EXCEPT "
+                      "SELECT term, doc, col, offset FROM temp.%s)")
+
+        with database.atomic() as transaction:
+            for sql in statements:
+                database.execute_sql(sql)
+
+            indexed = set(row[0] for row in database.execute_sql(
+                'SELECT DISTINCT doc FROM temp.ftsentry_vocab'))
+            changed = set(row[0] for row in database.execute_sql(
+                difference % ('ftsentry_expected_vocab', 'ftsentry_vocab')))
+            changed.update(row[0] for row in database.execute_sql(
+                difference % ('ftsentry_vocab', 'ftsentry_expected_vocab')))
+
+            # nothing here should be kept
+            transaction.rollback()
+
+        missing = sorted(changed - indexed)
+        stale = sorted(changed & indexed)
+        return (missing, stale)
+
+# keep FTSEntry in sync with the entry table, created by migrate_database
+# an external content table has to be told the old values to remove them
+SEARCH_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS entry_search_insert AFTER INSERT ON entry BEGIN
+        INSERT INTO ftsentry (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_search_delete AFTER DELETE ON entry BEGIN
+        INSERT INTO ftsentry (ftsentry, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_search_update AFTER UPDATE OF title, content ON entry BEGIN
+        INSERT INTO ftsentry (ftsentry, rowid, title, content)
+        VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO ftsentry (rowid, title, content)
+        VALUES (new.id, new.title, new.content);
+    END""",
+)
+
+# stores the rendered html of an entry, along with what it was rendered from,
+# so that html_content doesn't have to run markdown on every page view
+class EntryRender(flask_db.Model):
+
+    entry = ForeignKeyField(Entry, primary_key=True, backref='rendered')
+
+    # sha1 of the markdown the html was rendered from
+    content_hash = CharField()
+
+    # sha1 of the renderer settings and library versions, see render_signature
+    signature = CharField()
+
+    html = TextField()
+
+# a response from an oembed provider, or a failed request if data is null
+# key is micawber's hash of the url and the request parameters
+class OEmbedResponse(flask_db.Model):
+
+    key = CharField(primary_key=True)
+
+    url = TextField()
+
+    # json, needed to make the same request again when refreshing
+    params = TextField()
+
+    data = TextField(null=True)
+
+    fetched_at = DateTimeField(index=True)
+
+    expires = DateTimeField(index=True)
+
+    @classmethod
+    def store(cls, key, url, params, data):
+        now = datetime.datetime.now()
+        if data is None:
+            ttl = app.config['OEMBED_NEGATIVE_TTL']
+        else:
+            ttl = app.config['OEMBED_CACHE_TTL']
+            data = json.dumps(data)
+
+        with flask_db.writable():
+            (cls
+             .insert(key=key, url=url, params=json.dumps(params), data=data,
+                     fetched_at=now, expires=now + datetime.timedelta(seconds=ttl))
+             .on_conflict_replace()
+             .execute())
+
+    # drops everything but the most recently fetched responses, run by the
+    # render job and `flask oembed refresh` rather than on every store, see
+    # prune_render_caches
+    @classmethod
+    def prune(cls, size):
+        cutoff = (cls
+                  .select(cls.fetched_at)
+                  .order_by(cls.fetched_at.desc())
+                  .offset(size)
+                  .limit(1))
+        return cls.delete().where(cls.fetched_at <= cutoff).execute()
+
+# a code block highlighted by pygments, shared by every process so that a
+# snippet used in several entries is only highlighted once, see Renderer
+# key is a sha1 of the block's code, language and options, see highlight_key
+class HighlightedBlock(flask_db.Model):
+
+    key = CharField(primary_key=True)
+
+    html = TextField()
+
+    # the least recently used blocks are dropped past HIGHLIGHT_CACHE_SIZE
+    used_at = DateTimeField(index=True)
+
+    @classmethod
+    def lookup(cls, key):
+        block = cls.get_or_none(cls.key == key)
+        if block is None:
+            return None
+
+        # a day is close enough for dropping old blocks, and this way a page
+        # of blocks that are all in the cache doesn't write each of them
+        now = datetime.datetime.now()
+        if block.used_at < now - datetime.timedelta(days=1):
+            with flask_db.writable():
+                cls.update(used_at=now).where(cls.key == key).execute()
+        return block.html
+
+    @classmethod
+    def store(cls, key, html):
+        with flask_db.writable():
+            (cls
+             .insert(key=key, html=html, used_at=datetime.datetime.now())
+             .on_conflict_replace()
+             .execute())
+
+    # drops everything but the most recently used blocks, the cut off is found
+    # by stepping through the used_at index rather than comparing every row;
+    # that still steps over size rows, so it's run once per render job rather
+    # than for every stored block, see prune_render_caches
+    @classmethod
+    def prune(cls, size):
+        cutoff = (cls
+                  .select(cls.used_at)
+                  .order_by(cls.used_at.desc())
+                  .offset(size)
+                  .limit(1))
+        return cls.delete().where(cls.used_at <= cutoff).execute()
+
+# the tags purged from the response cache by any process, see
+# SharedResponseCache; the id only ever grows (sqlite's AUTOINCREMENT), so
+# it works as a generation number even after old rows are deleted
+class CacheInvalidation(flask_db.Model):
+
+    id = AutoIncrementField()
+
+    tag = CharField()
+
+    created_at = DateTimeField(index=True)
+
+    @classmethod
+    def latest(cls):
+        return cls.select(fn.MAX(cls.id)).scalar() or 0
+
+    @classmethod
+    def since(cls, generation):
+        return (cls
+                .select(cls.id, cls.tag)
+                .where(cls.id > generation)
+                .order_by(cls.id)
+                .tuples())
+
+    # rows older than RESPONSE_CACHE_TTL are dropped, any page stored before
+    # them has expired by now
+    @classmethod
+    def record(cls, tags):
+        now = datetime.datetime.now()
+        cutoff = now - datetime.timedelta(seconds=app.config['RESPONSE_CACHE_TTL'])
+        with flask_db.writable():
+            (cls
+             .insert_many([(tag, now) for tag in tags], fields=[cls.tag, cls.created_at])
+             .execute())
+            cls.delete().where(cls.created_at < cutoff).execute()
 
 # Implementing tags using the "Toxi" solution as suggested here:
 # https://stackoverflow.com/a/20871
@@ -303,11 +1587,120 @@ class Tag(flask_db.Model):
 
     title = CharField(unique=True)
 
+    # the number of published entries with this tag, kept up to date by
+    # TAG_COUNT_TRIGGERS so the tag cloud doesn't have to count them
+    entry_count = IntegerField(default=0)
+
+    # the tags with published entries, most used first, for the tag cloud
+    @classmethod
+    def cloud(cls):
+        return (cls
+                .select(cls.title, cls.entry_count)
+                .where(cls.entry_count > 0)
+                .order_by(cls.entry_count.desc(), cls.title))
+
+    # works out every count again, for a database that didn't have them
+    @classmethod
+    def recount(cls):
+        published = (EntryTag
+                     .select(fn.COUNT(EntryTag.id))
+                     .join(Entry)
+                     .where((EntryTag.tag == cls.id) & (Entry.published == True)))
+        cls.update(entry_count=published).execute()
+
+    # drops tags that no entry has any more, only looking at the given ids
+    # when there are some
+    @classmethod
+    def delete_unused(cls, tag_ids=None):
+        query = cls.delete().where(cls.id.not_in(EntryTag.select(EntryTag.tag)))
+        if tag_ids is not None:
+            query = query.where(cls.id.in_(tag_ids))
+        return query.execute()
+
+    # every page showing an entry with this tag has a link to it, so those
+    # entries are marked as modified (for their ETags and `flask freeze`)
+    # returns their ids, slugs and comma separated tags (from before the change)
+    def touch_entries(self):
+        tagged = EntryTag.select(EntryTag.entry).where(EntryTag.tag == self.id)
+        (Entry
+         .update(updated_at=datetime.datetime.now())
+         .where(Entry.id.in_(tagged))
+         .execute())
+        return list(EntryCard
+                    .select(EntryCard.entry, EntryCard.slug, EntryCard.tag_list)
+                    .where(EntryCard.entry.in_(tagged))
+                    .tuples())
+
+    # drops the cached pages that link this tag: the entries' own pages and
+    # the listings of every tag they have, which show their tag lists
+    def purge_cached_pages(self, entries, titles=()):
+        tags = set(['index', 'tag:%s' % self.title])
+        tags.update('tag:%s' % title for title in titles)
+        for (_, slug, tag_list) in entries:
+            tags.add('entry:%s' % slug)
+            tags.update('tag:%s' % title for title in tag_list.split(',') if title)
+        response_cache.delete_tags(sorted(tags))
+
+    # the entries' tags have changed, and so have the entries related to them
+    @staticmethod
+    def update_related(entries):
+        for (entry_id, _, _) in entries:
+            job_queue.enqueue('related', entry_id=entry_id)
+        job_queue.wake()
+
     def delete_instance(self):
-        query = EntryTag.delete().where(EntryTag.tag == self)
-        query.execute()
+        with database.atomic('IMMEDIATE'):
+            entries = self.touch_entries()
+            EntryTag.delete().where(EntryTag.tag == self.id).execute()
+            ret = super(Tag, self).delete_instance()
+
+        self.purge_cached_pages(entries)
+        self.update_related(entries)
 
-        return super(Tag, self).delete_instance()
+        return ret
+
+    # gives the tag a new title, or merges it into the tag that already has it
+    # returns the tag its entries end up with
+    def rename(self, title):
+        title = Tag.sanitize_query(title)
+        if not title.strip('_'):
+            raise ValueError('tag title %r has no letters or numbers' % title)
+        if title == self.title:
+            return self
+
+        target = Tag.get_or_none(Tag.title == title)
+        if target is not None:
+            return self.merge_into(target)
+
+        # the tag lists in EntryCard are updated by a trigger
+        with database.atomic('IMMEDIATE'):
+            entries = self.touch_entries()
+            Tag.update(title=title).where(Tag.id == self.id).execute()
+
+        self.purge_cached_pages(entries, [title])
+        self.title = title
+        return self
+
+    # moves this tag's entries over to target and deletes this tag, an entry
+    # that already has both keeps its link to target
+    # the counts and tag lists are updated by triggers
+    def merge_into(self, target):
+        if target.id == self.id:
+            return target
+
+        with database.atomic('IMMEDIATE'):
+            entries = self.touch_entries()
+            already_tagged = EntryTag.select(EntryTag.entry).where(EntryTag.tag == target.id)
+            (EntryTag
+             .update(tag=target.id)
+             .where((EntryTag.tag == self.id) & EntryTag.entry.not_in(already_tagged))
+             .execute())
+            EntryTag.delete().where(EntryTag.tag == self.id).execute()
+            super(Tag, self).delete_instance()
+
+        self.purge_cached_pages(entries, [target.title])
+        self.update_related(entries)
+        return target
 
     @classmethod
     def get_or_create(cls, **kwargs):
@@ -315,31 +1708,427 @@ class Tag(flask_db.Model):
             kwargs['title'] = Tag.sanitize_query(kwargs['title'])
         return super(Tag, cls).get_or_create(**kwargs)
 
+    # the entries with a tag, none for a tag that doesn't exist
     @classmethod
     def search(cls, query):
 
         sanitized_query = Tag.sanitize_query(query)
 
-        return (Entry
-                .select()
-                .join(EntryTag)
-                .where(EntryTag.tag == Tag.get(Tag.title == sanitized_query))
-                .order_by(Entry.timestamp.desc()) )
+        return (EntryCard
+                .listing()
+                .join(EntryTag, on=(EntryTag.entry == EntryCard.entry))
+                .join(Tag, on=(Tag.id == EntryTag.tag))
+                .where(Tag.title == sanitized_query)
+                .order_by(EntryCard.timestamp.desc()) )
 
     @staticmethod
     def sanitize_query(query):
         return re.sub('[^\w]+', '_', query.lower())
 
+# the tag cloud reads this index from the start, most used first
+Tag.add_index(Tag.entry_count.desc(), Tag.title)
+
+# keep Tag.entry_count in step with the links and with entries being
+# published, unpublished or deleted, created by migrate_database
+# published is stored as 0 or 1
+TAG_COUNT_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS entrytag_count_insert AFTER INSERT ON entrytag BEGIN
+        UPDATE tag SET entry_count = entry_count + 1
+        WHERE id = new.tag_id AND (SELECT published FROM entry WHERE id = new.entry_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entrytag_count_delete AFTER DELETE ON entrytag BEGIN
+        UPDATE tag SET entry_count = entry_count - 1
+        WHERE id = old.tag_id AND (SELECT published FROM entry WHERE id = old.entry_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entrytag_count_update
+    AFTER UPDATE OF entry_id, tag_id ON entrytag BEGIN
+        UPDATE tag SET entry_count = entry_count - 1
+        WHERE id = old.tag_id AND (SELECT published FROM entry WHERE id = old.entry_id);
+        UPDATE tag SET entry_count = entry_count + 1
+        WHERE id = new.tag_id AND (SELECT published FROM entry WHERE id = new.entry_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_count_publish AFTER UPDATE OF published ON entry
+    WHEN old.published != new.published BEGIN
+        UPDATE tag SET entry_count = entry_count + CASE WHEN new.published THEN 1 ELSE -1 END
+        WHERE id IN (SELECT tag_id FROM entrytag WHERE entry_id = new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_count_delete AFTER DELETE ON entry
+    WHEN old.published BEGIN
+        UPDATE tag SET entry_count = entry_count - 1
+        WHERE id IN (SELECT tag_id FROM entrytag WHERE entry_id = old.id);
+    END""",
+)
+
+# the number of published entries and the number of drafts, a row for each,
+# kept up to date by ENTRY_COUNT_TRIGGERS so the index never counts entries
+class EntryCount(flask_db.Model):
+
+    published = BooleanField(primary_key=True)
+
+    entries = IntegerField(default=0)
+
+    @classmethod
+    def total(cls, published):
+        return (cls
+                .select(cls.entries)
+                .where(cls.published == published)
+                .scalar()) or 0
+
+    # counts the entries once, when the table is created by migrate_database
+    @classmethod
+    def recount(cls):
+        for published in (True, False):
+            entries = Entry.select().where(Entry.published == published).count()
+            (cls
+             .insert(published=published, entries=entries)
+             .on_conflict_replace()
+             .execute())
+
+# keep EntryCount in step with entries being added, published, unpublished
+# and deleted, created by migrate_database
+ENTRY_COUNT_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS entrycount_insert AFTER INSERT ON entry BEGIN
+        UPDATE entrycount SET entries = entries + 1 WHERE published = new.published;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entrycount_delete AFTER DELETE ON entry BEGIN
+        UPDATE entrycount SET entries = entries - 1 WHERE published = old.published;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entrycount_publish AFTER UPDATE OF published ON entry
+    WHEN old.published != new.published BEGIN
+        UPDATE entrycount SET entries = entries - 1 WHERE published = old.published;
+        UPDATE entrycount SET entries = entries + 1 WHERE published = new.published;
+    END""",
+)
+
 class EntryTag(flask_db.Model):
 
     entry = ForeignKeyField(Entry, backref='tags')
 
     tag = ForeignKeyField(Tag, backref='entries')
 
+    # an entry can only have a tag once, this also serves lookups by entry
+    # (Tag.title is unique, so it already has an index for lookups by title)
+    # the second finds the entries with a tag without reading the table, which
+    # is what working out related entries mostly does
+    class Meta:
+        indexes = (
+            (('entry', 'tag'), True),
+            (('tag', 'entry'), False),
+        )
+
+
+# a narrow copy of every entry with its tags: what a listing shows and nothing
+# else, so a page of the index reads twenty small rows from one index instead
+# of each entry's content; only ever written by CARD_TRIGGERS
+class EntryCard(flask_db.Model):
+
+    entry = ForeignKeyField(Entry, primary_key=True, backref='card')
+
+    title = CharField()
+
+    slug = CharField()
+
+    summary = CharField()
+
+    published = BooleanField()
+
+    timestamp = DateTimeField()
+
+    # comma separated tag titles in the order they were added, tag titles are
+    # sanitized to word characters so they can't contain a comma
+    tag_list = TextField(default='')
+
+    # listings are filtered on published and read newest first
+    class Meta:
+        indexes = (
+            (('published', 'timestamp', 'entry'), False),
+        )
+
+    # a query for listings that returns Entry objects holding only these
+    # columns (and get_tags reads tag_list), so templates don't see a difference
+    @classmethod
+    def listing(cls):
+        return (cls
+                .select(cls.entry.alias('id'), cls.title, cls.slug, cls.summary,
+                        cls.published, cls.timestamp, cls.tag_list)
+                .objects(Entry))
+
+    # fills the table from the entries, for a database that didn't have it
+    @classmethod
+    def rebuild(cls):
+        cls.delete().execute()
+        database.execute_sql(
+            'INSERT INTO entrycard '
+            '(entry_id, title, slug, summary, published, timestamp, tag_list) '
+            'SELECT id, title, slug, summary, published, timestamp, %s '
+            'FROM entry' % (CARD_TAG_LIST % 'entry.id'))
+
+# the tag list of one entry as stored in EntryCard, %s is its id
+CARD_TAG_LIST = """coalesce((SELECT group_concat(title) FROM (
+        SELECT tag.title FROM entrytag JOIN tag ON tag.id = entrytag.tag_id
+        WHERE entrytag.entry_id = %s ORDER BY entrytag.id)), '')"""
+
+# keep EntryCard in sync with the entry, entrytag and tag tables, created by
+# migrate_database; like the search triggers these run in the same statement
+# as the write, so bulk inserts and set based updates are covered too
+CARD_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS entry_card_insert AFTER INSERT ON entry BEGIN
+        INSERT INTO entrycard (entry_id, title, slug, summary, published, timestamp, tag_list)
+        VALUES (new.id, new.title, new.slug, new.summary, new.published, new.timestamp, '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_card_update
+    AFTER UPDATE OF title, slug, summary, published, timestamp ON entry BEGIN
+        UPDATE entrycard
+        SET title = new.title, slug = new.slug, summary = new.summary,
+            published = new.published, timestamp = new.timestamp
+        WHERE entry_id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entry_card_delete AFTER DELETE ON entry BEGIN
+        DELETE FROM entrycard WHERE entry_id = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS entrytag_card_insert AFTER INSERT ON entrytag BEGIN
+        UPDATE entrycard SET tag_list = %s WHERE entry_id = new.entry_id;
+    END""" % (CARD_TAG_LIST % 'new.entry_id'),
+    """CREATE TRIGGER IF NOT EXISTS entrytag_card_delete AFTER DELETE ON entrytag BEGIN
+        UPDATE entrycard SET tag_list = %s WHERE entry_id = old.entry_id;
+    END""" % (CARD_TAG_LIST % 'old.entry_id'),
+    """CREATE TRIGGER IF NOT EXISTS entrytag_card_update AFTER UPDATE ON entrytag BEGIN
+        UPDATE entrycard SET tag_list = %s WHERE entry_id = old.entry_id;
+        UPDATE entrycard SET tag_list = %s WHERE entry_id = new.entry_id;
+    END""" % (CARD_TAG_LIST % 'old.entry_id', CARD_TAG_LIST % 'new.entry_id'),
+    """CREATE TRIGGER IF NOT EXISTS tag_card_update AFTER UPDATE OF title ON tag BEGIN
+        UPDATE entrycard SET tag_list = %s
+        WHERE entry_id IN (SELECT entry_id FROM entrytag WHERE tag_id = new.id);
+    END""" % (CARD_TAG_LIST % 'entrycard.entry_id'),
+)
+
+# the entries sharing the most tags with each entry, shown under it as related
+# posts; kept up to date by the 'related' job whenever an entry's tags change
+# (see update_related), so a page only has to read its own rows
+# only the best RELATED_KEPT are stored for each entry, drafts included (they
+# are skipped when shown, and don't need updating when published)
+class RelatedEntry(flask_db.Model):
+
+    entry = ForeignKeyField(Entry, backref='related_entries')
+
+    related = ForeignKeyField(Entry, backref='+')
+
+    # the number of tags the two entries share
+    score = IntegerField()
+
+    # an entry's rows are read best first, with newer entries ahead on a tie;
+    # the index on related (from the foreign key) finds the lists an entry is in
+    class Meta:
+        primary_key = CompositeKey('entry', 'related')
+        indexes = (
+            (('entry', 'score', 'related'), False),
+        )
+
+    # the published related entries of an entry, in one query on the index
+    @classmethod
+    def for_entry(cls, entry_id, limit):
+        return (EntryCard
+                .listing()
+                .join(cls, on=(cls.related == EntryCard.entry))
+                .where((cls.entry == entry_id) & (EntryCard.published == True))
+                .order_by(cls.score.desc(), cls.related.desc())
+                .limit(limit))
+
+    # brings the table up to date after the tags of one entry (or the entry
+    # itself) changed: its own list is worked out again, and it's put into,
+    # moved in or taken out of the other entries' lists, with a statement each
+    # rather than a query per entry it shares a tag with
+    # returns the ids of the entries whose lists changed
+    @classmethod
+    def update_entry(cls, entry_id):
+        keep = app.config['RELATED_KEPT']
+
+        with database.atomic('IMMEDIATE'):
+            # the lists this entry was in, and where
+            before = dict(cls
+                          .select(cls.entry, cls.score)
+                          .where(cls.related == entry_id)
+                          .tuples())
+
+            cls.delete().where((cls.entry == entry_id) | (cls.related == entry_id)).execute()
+            database.execute_sql(RELATED_LIST, (entry_id, entry_id, keep))
+
+            # a list with room for it, or whose last entry it is as good as,
+            # gets this entry, and any list that is now too long loses its last
+            database.execute_sql(RELATED_JOIN, (entry_id, entry_id, keep))
+            database.execute_sql(RELATED_TRIM, (entry_id, keep))
+
+            after = dict(cls
+                         .select(cls.entry, cls.score)
+                         .where(cls.related == entry_id)
+                         .tuples())
+
+            # a list this entry dropped down or out of may have a better entry
+            # that wasn't kept before, so those are worked out again
+            for (other_id, score) in before.items():
+                if after.get(other_id, 0) < score:
+                    cls.delete().where(cls.entry == other_id).execute()
+                    database.execute_sql(RELATED_LIST, (other_id, other_id, keep))
+
+        return set(before) | set(after) | {entry_id}
+
+    # works out every entry's list again, for a database that didn't have them
+    @classmethod
+    def rebuild(cls):
+        keep = app.config['RELATED_KEPT']
+        cls.delete().execute()
+        for (entry_id,) in Entry.select(Entry.id).tuples():
+            database.execute_sql(RELATED_LIST, (entry_id, entry_id, keep))
+
+# the entries sharing tags with an entry and how many they share, found
+# through the entrytag index on tag_id
+RELATED_SCORES = """SELECT other.entry_id AS related_id, COUNT(*) AS score
+    FROM entrytag AS mine JOIN entrytag AS other ON other.tag_id = mine.tag_id
+    WHERE mine.entry_id = ? AND other.entry_id != mine.entry_id
+    GROUP BY other.entry_id"""
+
+# stores an entry's list (its id, then RELATED_SCORES' and the list length)
+RELATED_LIST = """INSERT INTO relatedentry (entry_id, related_id, score)
+    SELECT ?, related_id, score FROM (%s)
+    ORDER BY score DESC, related_id DESC LIMIT ?""" % RELATED_SCORES
+
+# adds an entry to the lists it belongs in (its id, RELATED_SCORES' and the
+# list length), a list that is full takes it if it ties with the last entry and
+# RELATED_TRIM sorts out which of the two stays
+RELATED_JOIN = """INSERT INTO relatedentry (entry_id, related_id, score)
+    SELECT scores.related_id, ?, scores.score FROM (%s) AS scores
+    WHERE (SELECT COUNT(*) FROM relatedentry AS r WHERE r.entry_id = scores.related_id) < ?
+    OR scores.score >= (SELECT MIN(score) FROM relatedentry AS r
+                        WHERE r.entry_id = scores.related_id)""" % RELATED_SCORES
+
+# drops the last entry of the lists that an entry was added to and are now
+# too long (the entry's id and the list length)
+RELATED_TRIM = """DELETE FROM relatedentry WHERE (entry_id, related_id) IN (
+    SELECT entry_id, related_id FROM (
+        SELECT entry_id, related_id, row_number() OVER (
+            PARTITION BY entry_id ORDER BY score DESC, related_id DESC) AS rank
+        FROM relatedentry
+        WHERE entry_id IN (SELECT entry_id FROM relatedentry WHERE related_id = ?))
+    WHERE rank > ?)"""
+
+# work queued by JobQueue, see JOB_HANDLERS
+class Job(flask_db.Model):
+
+    # name of the handler to run
+    kind = CharField()
+
+    # kind and payload together, used to avoid queueing the same job twice
+    key = CharField(index=True)
+
+    # json keyword arguments for the handler
+    payload = TextField()
+
+    # queued, running, done or failed
+    status = CharField(default='queued')
+
+    attempts = IntegerField(default=0)
+
+    # the exception from the last failed attempt
+    error = TextField(null=True)
+
+    created_at = DateTimeField(default=datetime.datetime.now)
+
+    # not run before this time, pushed back after each failure
+    run_after = DateTimeField(default=datetime.datetime.now)
+
+    started_at = DateTimeField(null=True)
+
+    finished_at = DateTimeField(null=True, index=True)
+
+    # workers look for the next job by status and run_after
+    class Meta:
+        indexes = (
+            (('status', 'run_after'), False),
+        )
+
+    # what the uploader script sees when it polls a job
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'error': self.error,
+        }
+
+    # drops jobs that finished more than the given number of seconds ago
+    @classmethod
+    def prune(cls, seconds):
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+        return (cls
+                .delete()
+                .where(cls.status.in_(['done', 'failed']) & (cls.finished_at < cutoff))
+                .execute())
+
+# renders an entry's html, fetching any embeds it links to, and drops the
+# pages that were cached while the new html wasn't stored yet
+@job_handler('render')
+def render_entry(entry_id):
+    entry = Entry.get_or_none(Entry.id == entry_id)
+
+    # deleted since the job was queued
+    if entry is None:
+        return
+
+    with fetching_oembeds():
+        entry.update_rendered_html()
+
+    entry.purge_cached_pages(entry.get_tags())
+    prune_render_caches()
+
+# keeps the highlighted blocks and oembed responses to their configured
+# sizes, the tables may go over by what one render stored until the next
+def prune_render_caches():
+    with flask_db.writable():
+        HighlightedBlock.prune(app.config['HIGHLIGHT_CACHE_SIZE'])
+        OEmbedResponse.prune(app.config['OEMBED_CACHE_SIZE'])
+
+# updates the related entries after an entry's tags changed (or it was
+# deleted), and drops the cached pages whose lists changed
+@job_handler('related')
+def update_related(entry_id):
+    changed = RelatedEntry.update_entry(entry_id)
+
+    slugs = []
+    for batch in chunked(list(changed), 500):
+        slugs.extend(slug for (slug,) in (Entry
+                                          .select(Entry.slug)
+                                          .where(Entry.id.in_(batch))
+                                          .tuples()))
+    response_cache.delete_tags(['entry:%s' % slug for slug in slugs])
+
+
 ##################
 # Application Functions
 ##################
 
+def hash_content(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+# identifies everything that affects the rendered html apart from the content
+# itself, so upgrading markdown or pygments or changing the config will cause
+# stored html to be re-rendered
+def render_signature():
+    parts = (
+        RENDERER_VERSION,
+        *renderer_versions(),
+        sorted(app.config['CODEHILITE_CONFIG'].items()),
+        app.config['SITE_WIDTH'],
+        app.config['OEMBED_OFFLINE'])
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+# identifies a code block's highlighted html: its code, language (or that it
+# is guessed), the codehilite options, and the library versions
+# block is the CodeHilite about to highlight it, all of that is in its attributes
+def highlight_key(block, args, kwargs):
+    parts = (sorted(vars(block).items()), args, sorted(kwargs.items()), renderer_versions())
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
 # custom wrapper to redirect user to login page if they're trying to
 # access an admin-only page
 def login_required(fn):
@@ -368,6 +2157,54 @@ def login_required(fn):
 
     return inner
 
+# serves logged out readers a stored copy of the page if there is one, and
+# stores the page otherwise; see ResponseCache for how copies are dropped
+def cached_page(fn):
+
+    @functools.wraps(fn)
+    def inner(*args, **kwargs):
+
+        # logged in users see drafts and edit links, and flashed messages are
+        # only meant to be shown once, so neither can be served from the cache
+        if (session.get('logged_in') or session.get('_flashes') or
+                request.method != 'GET'):
+            return fn(*args, **kwargs)
+
+        key = request.path + '?' + clean_querystring(request.args)
+
+        cached = response_cache.get(key)
+        if cached is not None:
+            (data, status, headers) = cached
+            # the stored headers include the ETag, so this can still be a 304
+            return Response(data, status, headers).make_conditional(request)
+
+        response = app.make_response(fn(*args, **kwargs))
+
+        # only store the body and headers, Response objects get modified
+        # after the view returns (session cookies, etc.)
+        # a view sets skip_response_cache for a page that is only good once
+        if (response.status_code == 200 and not response.is_streamed and
+                not g.get('skip_response_cache')):
+            response_cache.set(
+                key,
+                (response.get_data(), response.status_code, list(response.headers)),
+                cached_page_tags())
+
+        return response
+
+    return inner
+
+# the invalidation tags for the page being requested, these have to match
+# the ones purged in Entry.purge_cached_pages and Tag.delete_instance
+def cached_page_tags():
+    if request.endpoint == 'detail':
+        # the page also shows the titles of the related entries
+        slugs = [request.view_args['slug']] + g.get('related_slugs', [])
+        return ['entry:%s' % slug for slug in slugs]
+    if request.args.get('t') and not request.args.get('q'):
+        return ['tag:%s' % Tag.sanitize_query(request.args['t'])]
+    return ['index']
+
 # i have no idea what this function does yet and can't seem to figure it out
 # the only instance I have seen this used is in templates/includes/pagination.html
 @app.template_filter('clean_querystring')
@@ -378,7 +2215,494 @@ def clean_querystring(request_args, *keys_to_remove, **new_values):
     querystring.update(new_values)
 
     # previously this had urllib.urlencode but it is now at the below
-    return urllib.parse.urlencode(querystring)
+    # sorted so the same arguments always produce the same string, which the
+    # response cache relies on
+    return urllib.parse.urlencode(sorted(querystring.items()))
+
+# one page of a listing ordered newest first, found by its position relative
+# to a (timestamp, id) cursor instead of an OFFSET, so every page is a range
+# scan of the timestamp index no matter how far back it is
+# this stands in for the PaginatedQuery that object_list passes to templates
+# the query can be on Entry or EntryCard, both have a timestamp and an id
+class KeysetPage(object):
+
+    def __init__(self, query, before=None, after=None, per_page=20, count=None):
+        self.per_page = per_page
+        self.count = count
+
+        model = query.model
+        (timestamp, key) = (model.timestamp, model._meta.primary_key)
+        ordered = (timestamp.desc(), key.desc())
+
+        if after is not None:
+            # newer entries, read oldest first and flipped back afterwards
+            rows = list(query
+                        .where(cursor_expression(model, after, newer=True))
+                        .order_by(timestamp.asc(), key.asc())
+                        .limit(per_page + 1))
+
+            if len(rows) > per_page:
+                self.object_list = list(reversed(rows[:per_page]))
+                self.has_newer = True
+                self.has_older = True
+                return
+
+            # fewer than a page of newer entries means this is the first page
+            after = None
+
+        if before is not None:
+            query = query.where(cursor_expression(model, before, newer=False))
+
+        rows = list(query.order_by(*ordered).limit(per_page + 1))
+        self.object_list = rows[:per_page]
+        self.has_older = len(rows) > per_page
+        self.has_newer = before is not None
+
+    @property
+    def older_cursor(self):
+        if self.has_older and self.object_list:
+            return make_cursor(self.object_list[-1])
+
+    @property
+    def newer_cursor(self):
+        if self.has_newer and self.object_list:
+            return make_cursor(self.object_list[0])
+
+def make_cursor(entry):
+    return '%s_%s' % (entry.timestamp.isoformat(), entry.id)
+
+# the where clause for entries older (or newer) than the cursor
+# the first comparison on timestamp alone lets sqlite use the index to find
+# where to start, the second breaks ties between equal timestamps by id
+def cursor_expression(model, cursor, newer):
+    try:
+        (timestamp, entry_id) = cursor.rsplit('_', 1)
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+        entry_id = int(entry_id)
+    except ValueError:
+        abort(404)
+
+    key = model._meta.primary_key
+    if newer:
+        return ((model.timestamp >= timestamp) &
+                ((model.timestamp > timestamp) | (key > entry_id)))
+    else:
+        return ((model.timestamp <= timestamp) &
+                ((model.timestamp < timestamp) | (key < entry_id)))
+
+# like object_list, but for listings ordered newest first, see KeysetPage
+def keyset_list(template_name, query, count=None, **kwargs):
+    pagination = KeysetPage(
+        query,
+        before=request.args.get('before'),
+        after=request.args.get('after'),
+        per_page=app.config['PAGINATE_BY'],
+        count=count)
+    return render_template(
+        template_name,
+        pagination=pagination,
+        object_list=pagination.object_list,
+        **kwargs)
+
+# markers put around matched terms by the snippet function, they can't appear
+# in the content so the snippet can be escaped before they are turned into html
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+# turns user input into an FTS5 query, every word has to match
+# "quoted phrases" are kept together and a trailing * matches a prefix, other
+# punctuation is quoted so it can't be read as query syntax (or cause an error)
+def fts_query(query):
+    terms = []
+    for (phrase, word) in re.findall(r'"([^"]*)"|(\S+)', query):
+        if phrase.strip():
+            terms.append('"%s"' % phrase.strip())
+        elif word:
+            prefix = '*' if word.endswith('*') else ''
+            word = word.replace('"', '').rstrip('*')
+            if word:
+                terms.append('"%s"%s' % (word, prefix))
+    return ' '.join(terms)
+
+@app.template_filter('highlight_snippet')
+def highlight_snippet(snippet):
+    html = str(Markup.escape(snippet))
+    html = html.replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+    return Markup(html)
+
+# splits an uploaded markdown file into its front matter and content
+# front matter is an optional block of `key: value` lines between two `---`
+# lines at the very top of the file, e.g.
+#   ---
+#   title: My post
+#   tags: python, flask
+#   published: true
+#   timestamp: 2021-04-01 12:00:00
+#   ---
+def parse_front_matter(text):
+    meta = {}
+    lines = text.lstrip('\ufeff').splitlines(True)
+    if lines and lines[0].strip() == '---':
+        for (i, line) in enumerate(lines[1:], 1):
+            if line.strip() == '---':
+                return (meta, ''.join(lines[i + 1:]).lstrip('\n'))
+            (key, _, value) = line.partition(':')
+            meta[key.strip().lower()] = value.strip()
+    # no closing line, so there wasn't any front matter
+    return ({}, text)
+
+# builds an unsaved entry and its tags from an uploaded markdown file
+# raises ValueError if the file can't be used
+def entry_from_markdown(filename, data):
+    (meta, content) = parse_front_matter(data.decode('utf-8'))
+
+    title = meta.get('title') or os.path.splitext(os.path.basename(filename))[0]
+    if not title or not content.strip():
+        raise ValueError('title and content are required')
+
+    entry = Entry(
+        title=title,
+        content=content,
+        published=meta.get('published', '').lower() in ('true', 'yes', '1'))
+
+    if meta.get('timestamp'):
+        entry.timestamp = datetime.datetime.fromisoformat(meta['timestamp'])
+
+    tags = [t.strip() for t in meta.get('tags', '').split(',') if t.strip()]
+    return (entry, tags)
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown', '.txt')
+
+# yields (filename, bytes) for every markdown file in the upload, files can
+# be sent one by one or inside a zip or tar archive
+def uploaded_markdown_files(files):
+    for file in files:
+        name = file.filename or ''
+        data = file.stream.read()
+
+        if name.endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.endswith(MARKDOWN_EXTENSIONS):
+                        yield (info.filename, archive.read(info))
+        elif name.endswith(('.tar', '.tar.gz', '.tgz')):
+            with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+                for member in archive.getmembers():
+                    if member.isfile() and member.name.endswith(MARKDOWN_EXTENSIONS):
+                        yield (member.name, archive.extractfile(member).read())
+        else:
+            yield (name, data)
+
+# feed dates are in utc, timestamps are stored in local time
+def atom_date(value):
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def rss_date(value):
+    return email.utils.format_datetime(value.astimezone(datetime.timezone.utc))
+
+# the xml for one entry in a feed, kept in the response cache under the
+# entry's tag so only new or edited entries are rendered again
+def feed_entry_xml(entry, feed_format):
+    key = 'feed:%s:%s:%s' % (feed_format, entry.id, render_signature())
+    fragment = response_cache.get(key)
+    if fragment is not None:
+        return fragment
+
+    url = url_for('detail', slug=entry.slug, _external=True)
+    title = xml_escape(entry.title)
+    html = xml_escape(entry.update_rendered_html())
+
+    # rendered here with some embeds left out, the next request gets the copy
+    # the render job stores (see detail)
+    cacheable = not oembed_state.missed
+    tags = entry.get_tags()
+
+    if feed_format == 'atom':
+        fragment = (
+            '<entry>'
+            '<title>%s</title>'
+            '<id>%s</id>'
+            '<link href="%s"/>'
+            '<published>%s</published>'
+            '<updated>%s</updated>'
+            '%s'
+            '<summary>%s</summary>'
+            '<content type="html">%s</content>'
+            '</entry>\n' % (
+                title, xml_escape(url), xml_escape(url),
+                atom_date(entry.timestamp), atom_date(entry.updated_at),
+                ''.join('<category term="%s"/>' % xml_escape(t) for t in tags),
+                xml_escape(entry.summary), html))
+    else:
+        fragment = (
+            '<item>'
+            '<title>%s</title>'
+            '<link>%s</link>'
+            '<guid isPermaLink="true">%s</guid>'
+            '<pubDate>%s</pubDate>'
+            '%s'
+            '<description>%s</description>'
+            '</item>\n' % (
+                title, xml_escape(url), xml_escape(url),
+                rss_date(entry.timestamp),
+                ''.join('<category>%s</category>' % xml_escape(t) for t in tags),
+                html))
+
+    if cacheable:
+        response_cache.set(key, fragment, ['entry:%s' % entry.slug])
+    return fragment
+
+# yields the feed a piece at a time so the response can be streamed
+def generate_feed(entries, feed_format, last_modified):
+    site_url = xml_escape(url_for('index', _external=True))
+    feed_url = xml_escape(request.url)
+    site_name = xml_escape(app.config['SITE_NAME'])
+
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+
+    if feed_format == 'atom':
+        yield ('<feed xmlns="http://www.w3.org/2005/Atom">'
+               '<title>%s</title>'
+               '<id>%s</id>'
+               '<link href="%s" rel="self"/>'
+               '<link href="%s"/>'
+               '<updated>%s</updated>'
+               '<author><name>%s</name></author>\n' % (
+                   site_name, site_url, feed_url, site_url,
+                   atom_date(last_modified or datetime.datetime.now()),
+                   xml_escape(app.config['SITE_AUTHOR'])))
+    else:
+        yield ('<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">'
+               '<channel>'
+               '<title>%s</title>'
+               '<link>%s</link>'
+               '<description>%s</description>'
+               '<atom:link href="%s" rel="self" type="application/rss+xml"/>\n' % (
+                   site_name, site_url, site_name, feed_url))
+
+    for entry in entries:
+        yield feed_entry_xml(entry, feed_format)
+
+    if feed_format == 'atom':
+        yield '</feed>\n'
+    else:
+        yield '</channel></rss>\n'
+
+# gives each tag of the cloud a size from 1 to 5, on a log scale so that a
+# few very common tags don't leave the rest all the same size
+def tag_cloud(tags):
+    most = max((tag.entry_count for tag in tags), default=1)
+    for tag in tags:
+        if most > 1:
+            tag.size = 1 + int(4 * math.log(tag.entry_count) / math.log(most))
+        else:
+            tag.size = 1
+    return tags
+
+# yields the sitemap a piece at a time, entries is a list of (slug, updated_at)
+def generate_sitemap(entries, last_modified):
+    yield ('<?xml version="1.0" encoding="utf-8"?>\n'
+           '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+
+    pages = [(url_for('index', _external=True), last_modified),
+             (url_for('about_me', _external=True), None)]
+    pages += [(url_for('detail', slug=slug, _external=True), updated_at)
+              for (slug, updated_at) in entries]
+
+    for (url, updated_at) in pages:
+        if updated_at is None:
+            yield '<url><loc>%s</loc></url>\n' % xml_escape(url)
+        else:
+            yield '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+                xml_escape(url), atom_date(updated_at))
+
+    yield '</urlset>\n'
+
+# what the validators of the listings are built from, without counting the
+# entry table: the number of published entries (kept in EntryCount) changes
+# when one is added, published or deleted,
+# and the latest updated_at (read from the end of its index) when one is saved
+# published_only -- the latest published entry, walking back past any drafts
+def listing_state(published_only=False):
+    query = (Entry
+             .select(Entry.updated_at)
+             .order_by(Entry.updated_at.desc())
+             .limit(1))
+    if published_only:
+        query = query.where(Entry.published == True)
+    return (Entry.public_count(), query.scalar())
+
+# builds the ETag and Last-Modified values for a page from whatever
+# identifies its content (an entry id, a count, etc.) and when it last changed
+# logged in users see edit links, so they get a different ETag
+def page_validators(last_modified, *parts):
+    parts = parts + (last_modified, bool(session.get('logged_in')), render_signature())
+    etag = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    # timestamps are stored in local time, http dates are in utc
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(datetime.timezone.utc)
+
+    return (etag, last_modified)
+
+# returns an empty 304 response if the client already has the current version
+# of the page, so views can check this before rendering anything
+def not_modified(etag, last_modified):
+    if session.get('_flashes'):
+        return None
+
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+# adds the validators from page_validators to a rendered page
+def conditional_response(rv, etag, last_modified):
+    response = app.make_response(rv)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+# static files that are worth compressing
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.xml')
+
+# CSS_COMMENT keeps /*! ... */ comments, which are used for licenses
+# CSS_TOKEN matches comments and quoted strings, so that neither is minified
+# (a comment can hold a quote and a string can hold "/*")
+CSS_COMMENT = re.compile(r'/\*(?!!).*?\*/', re.S)
+CSS_TOKEN = re.compile(r'/\*.*?\*/|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'', re.S)
+CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+
+# a conservative css minifier: drops comments and whitespace that can't
+# matter, but leaves strings and things like calc(1em + 2px) alone
+def minify_css(css):
+    parts = []
+    # the css since the last string, dropped comments are replaced by a space
+    code = ''
+    position = 0
+    for match in CSS_TOKEN.finditer(css):
+        code += css[position:match.start()]
+        position = match.end()
+        if CSS_COMMENT.fullmatch(match.group()):
+            code += ' '
+        else:
+            parts.append(minify_css_code(code))
+            parts.append(match.group())
+            code = ''
+    parts.append(minify_css_code(code + css[position:]))
+    return ''.join(parts).strip()
+
+# the whitespace rules, for the css between comments and strings
+def minify_css_code(css):
+    css = re.sub(r'\s+', ' ', css)
+    css = CSS_PUNCTUATION.sub(r'\1', css)
+    # a space before a colon can matter ("a :hover"), after one it never does
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}')
+
+# writes the hashed copies of everything under static/ (apart from robots.txt,
+# which has to keep its name, and earlier builds) and returns the manifest
+# original name -> {'path': hashed name, 'encodings': precompressed copies}
+def build_assets(static_folder, build_dir):
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    manifest = {}
+    for (root, dirs, files) in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if d != build_dir]
+            files = [f for f in files if f != 'robots.txt']
+
+        for filename in sorted(files):
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+
+            if name.endswith('.css') and not name.endswith('.min.css'):
+                data = minify_css(data.decode('utf-8')).encode('utf-8')
+
+            (base, extension) = os.path.splitext(name)
+            path = '%s/%s.%s%s' % (
+                build_dir, base, hashlib.sha1(data).hexdigest()[:12], extension)
+            target = os.path.join(static_folder, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            copies = {path: data}
+            encodings = []
+            if extension in COMPRESSIBLE_EXTENSIONS:
+                # mtime=0 so a rebuild of the same file is byte for byte the same
+                compressed = (('gzip', '.gz', gzip.compress(data, 9, mtime=0)),)
+                if brotli is not None:
+                    compressed += (('br', '.br', brotli.compress(data)),)
+                for (encoding, suffix, body) in compressed:
+                    if len(body) < len(data):
+                        copies[path + suffix] = body
+                        encodings.append(encoding)
+
+            for (copy, body) in copies.items():
+                with open(os.path.join(static_folder, copy), 'wb') as f:
+                    f.write(body)
+
+            manifest[name] = {'path': path, 'encodings': encodings}
+
+    with open(os.path.join(static_folder, build_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+def load_asset_manifest():
+    path = os.path.join(app.static_folder, app.config['ASSETS_DIR'], 'manifest.json')
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+# original name -> hashed copy, and hashed copy -> its precompressed
+# encodings, filled in by configure_app
+asset_manifest = {}
+asset_encodings = {}
+
+# url_for('static', filename='css/main.css') links the hashed copy, if there is one
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and values.get('filename') in asset_manifest:
+        values['filename'] = asset_manifest[values['filename']]['path']
+
+# replaces flask's static view, hashed copies are sent precompressed in the
+# best encoding the browser accepts and are cached for good; anything else is
+# served as before
+def send_static_asset(filename):
+    if filename not in asset_encodings:
+        return app.send_static_file(filename)
+
+    (mimetype, _) = mimetypes.guess_type(filename)
+    encoding = None
+    for candidate in ('br', 'gzip'):
+        if candidate in asset_encodings[filename] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+
+    if encoding:
+        suffix = '.br' if encoding == 'br' else '.gz'
+        response = send_from_directory(
+            app.static_folder, filename + suffix, mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = send_from_directory(app.static_folder, filename, mimetype=mimetype)
+
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % (
+        app.config['ASSETS_MAX_AGE'])
+    response.vary.add('Accept-Encoding')
+    return response
+
+app.view_functions['static'] = send_static_asset
 
 # errorhandler - Register a function to handle errors by code or exception class.
 @app.errorhandler(404)
@@ -432,24 +2756,124 @@ def logout():
     return render_template('logout.html')
 
 @app.route('/')
+@cached_page
 def index(q=None, t=None):
+    # every listing changes when an entry is added, removed or modified, see
+    # listing_state; logged in users also see the drafts
+    (entry_count, last_modified) = listing_state()
+    parts = [entry_count]
+    if session.get('logged_in'):
+        parts.append(Entry.draft_count())
+    (etag, last_modified) = page_validators(last_modified, *parts)
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
     search_query = request.args.get('q') or q
     tag_search_query = request.args.get('t') or t
     search_title=None
     if search_query:
-        query = Entry.search(search_query)
+        # results are ordered by rank rather than time, so these still use
+        # numbered pages
+        query = Entry.with_tags(Entry.search(search_query))
         search_title = search_query
+
+        # object_list retrieves a paginated list of object in the query
+        # and displays them using the template provided
+        return conditional_response(
+            object_list('index.html', query, paginate_by=app.config['PAGINATE_BY'],
+                        check_bounds=False, search=search_title),
+            etag, last_modified)
     elif tag_search_query:
         query = Tag.search(tag_search_query)
+        # drafts are only listed for the logged in user, like on the index
+        if not session.get('logged_in'):
+            query = query.where(EntryCard.published == True)
         search_title = "Tag: " + tag_search_query
+        count = None
     else:
-        query = Entry.public().order_by(Entry.timestamp.desc())
-
-    # object_list retrieves a paginated list of object in the query
-    # and displays them using the template provided
-    # by default, it paginates by 20 but this can be specified by a
-    # variable paginate_by
-    return object_list('index.html', query, search=search_title)
+        query = Entry.cards()
+        count = entry_count
+
+    # both listings read EntryCard, which already has the tags
+    return conditional_response(
+        keyset_list('index.html', query, count=count,
+                    search=search_title),
+        etag, last_modified)
+
+@app.route('/feed.xml', defaults={'feed_format': 'atom'})
+@app.route('/rss.xml', defaults={'feed_format': 'rss'})
+def feed(feed_format):
+    (entry_count, last_modified) = listing_state(published_only=True)
+
+    # the feed holds the entries' html, which changes without them being
+    # saved when the render job (or `flask rerender`) stores a new copy
+    rendered = (Entry
+                .select(Entry.id, EntryRender.html)
+                .join(EntryRender, JOIN.LEFT_OUTER, on=(EntryRender.entry == Entry.id))
+                .where(Entry.published == True)
+                .order_by(Entry.timestamp.desc(), Entry.id.desc())
+                .limit(app.config['FEED_SIZE'])
+                .tuples())
+    (etag, http_last_modified) = page_validators(
+        last_modified, entry_count, feed_format, hash_content(repr(list(rendered))))
+    response = not_modified(etag, http_last_modified)
+    if response:
+        return response
+
+    entries = list(Entry.with_tags(Entry.public())
+                   .order_by(Entry.timestamp.desc(), Entry.id.desc())
+                   .limit(app.config['FEED_SIZE']))
+
+    if feed_format == 'atom':
+        mimetype = 'application/atom+xml'
+    else:
+        mimetype = 'application/rss+xml'
+
+    # stream_with_context keeps the request around while the generator runs,
+    # url_for needs it
+    response = Response(
+        stream_with_context(generate_feed(entries, feed_format, last_modified)),
+        mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = http_last_modified
+    return response
+
+# every public page, for search engines
+@app.route('/sitemap.xml')
+def sitemap():
+    (entry_count, last_modified) = listing_state(published_only=True)
+    (etag, http_last_modified) = page_validators(last_modified, entry_count, 'sitemap')
+    response = not_modified(etag, http_last_modified)
+    if response:
+        return response
+
+    entries = list(Entry
+                   .select(Entry.slug, Entry.updated_at)
+                   .where(Entry.published == True)
+                   .order_by(Entry.timestamp.desc(), Entry.id.desc())
+                   .tuples())
+
+    response = Response(
+        stream_with_context(generate_sitemap(entries, last_modified)),
+        mimetype='application/xml')
+    response.set_etag(etag)
+    response.last_modified = http_last_modified
+    return response
+
+# prometheus scrapes this, see SERVER_TIMING and METRICS_TOKEN in the config
+@app.route('/metrics')
+def metrics():
+    token = app.config.get('METRICS_TOKEN')
+    authorized = session.get('logged_in') or (
+        token and request.headers.get('Authorization') == 'Bearer %s' % token)
+    if not authorized:
+        abort(403)
+
+    body = ''.join(histogram.expose() for histogram in
+                   (request_seconds, request_queries, request_query_seconds,
+                    stage_seconds, job_seconds))
+    return Response(body, mimetype='text/plain; version=0.0.4')
 
 @app.route('/about/')
 def about_me():
@@ -458,8 +2882,7 @@ def about_me():
 @app.route('/drafts/')
 @login_required
 def drafts():
-    query = Entry.drafts().order_by(Entry.timestamp.desc())
-    return object_list('index.html', query)
+    return keyset_list('index.html', Entry.cards(published=False))
 
 @app.route('/create/', methods=['GET', 'POST'])
 @login_required
@@ -510,30 +2933,173 @@ def upload():
             published = published)
 
         # code 201 -- requested resource has been created
-        return {'file_uploaded': True}, 201
+        # the entry is rendered in the background, the script can poll
+        # status_url until that is done
+        return {'file_uploaded': True,
+                'slug': entry.slug,
+                'job': entry.render_job.id,
+                'status_url': url_for('job_status', job_id=entry.render_job.id)}, 201
 
     except:
         # code 400 -- bad request
         return {'file_uploaded': False}, 400
 
-@app.route('/tags/', methods=['GET', 'POST'])
+# Uploads many markdown files with front matter at once, either as a list of
+# uploaded_files or as zip/tar archives of them
+# responds with a report of what happened to each file
+@app.route('/upload/batch/', methods=['POST'])
+@login_required
+def upload_batch():
+    # ensure we are only uploading from the script
+    if request.headers.get('User-Agent') != app.config['UPLOADER_USER_AGENT']:
+        return {'files': []}, 400
+
+    report = []
+    entries = []
+    slugs = set()
+
+    try:
+        for (filename, data) in uploaded_markdown_files(
+                request.files.getlist('uploaded_files')):
+            try:
+                (entry, tags) = entry_from_markdown(filename, data)
+            except (UnicodeDecodeError, ValueError) as exc:
+                report.append({'file': filename, 'file_uploaded': False, 'error': str(exc)})
+                continue
+
+            entry.update_slug()
+            if entry.slug in slugs:
+                report.append({'file': filename, 'file_uploaded': False,
+                               'error': 'duplicate slug %s' % entry.slug})
+                continue
+            slugs.add(entry.slug)
+
+            entries.append((entry, tags))
+            report.append({'file': filename, 'file_uploaded': True, 'slug': entry.slug})
+    except (zipfile.BadZipFile, tarfile.TarError) as exc:
+        return {'files': report, 'error': str(exc)}, 400
+
+    # slugs already used by existing entries
+    taken = set()
+    for batch in chunked(list(slugs), 500):
+        taken.update(e.slug for e in Entry.select(Entry.slug).where(Entry.slug.in_(batch)))
+
+    for result in report:
+        if result.get('slug') in taken:
+            result.update(file_uploaded=False, error='slug %s already exists' % result.pop('slug'))
+    entries = [(entry, tags) for (entry, tags) in entries if entry.slug not in taken]
+
+    if entries:
+        Entry.import_many(entries)
+
+        # each entry is rendered by its own job, see upload
+        jobs = dict((entry.slug, entry.render_job.id) for (entry, _) in entries)
+        for result in report:
+            if result.get('slug') in jobs:
+                job_id = jobs[result['slug']]
+                result.update(job=job_id, status_url=url_for('job_status', job_id=job_id))
+
+    # code 201 -- requested resource has been created
+    return {'files': report}, (201 if entries else 400)
+
+# the state of a background job, polled by the uploader script after an upload
+@app.route('/jobs/<int:job_id>/')
+@login_required
+def job_status(job_id):
+    job = get_object_or_404(Job, Job.id == job_id)
+    return job.to_dict()
+
+# every tag with published entries, most used first
+@app.route('/tags/')
+@cached_page
 def list_tags():
-    if request.method == 'POST':
-        tag = Tag.get(Tag.title == request.form.get('tag_title'))
+    return render_template('tags.html', tags=tag_cloud(list(Tag.cloud())))
+
+# the same as a list of {'title', 'count', 'url'}
+@app.route('/tags.json')
+@cached_page
+def tags_json():
+    return {'tags': [{'title': tag.title,
+                      'count': tag.entry_count,
+                      'url': url_for('index', t=tag.title)}
+                     for tag in Tag.cloud()]}
+
+# renames, merges or deletes the tag_title tag, from the form on the tags page
+# or a json body with the same fields
+# action -- 'rename' (which merges if new_title is taken), 'merge' into the
+#   existing new_title tag, or 'delete'
+@app.route('/tags/', methods=['POST'])
+@login_required
+def manage_tags():
+    data = request.get_json(silent=True) or request.form
+    action = data.get('action', 'delete')
+    tag = Tag.get_or_none(Tag.title == Tag.sanitize_query(data.get('tag_title', '')))
+    new_title = data.get('new_title', '')
+
+    status = 200
+    if tag is None:
+        (message, status) = ('No tag named %s.' % data.get('tag_title', ''), 404)
+    elif action == 'delete':
         tag.delete_instance()
-    return render_template('tags.html', tags=[t.title for t in Tag.select()])
+        message = 'Tag %s deleted.' % tag.title
+    elif action == 'merge':
+        target = Tag.get_or_none(Tag.title == Tag.sanitize_query(new_title))
+        if target is None:
+            (message, status) = ('No tag named %s to merge into.' % new_title, 404)
+        else:
+            tag.merge_into(target)
+            message = 'Tag %s merged into %s.' % (tag.title, target.title)
+    elif action == 'rename':
+        old_title = tag.title
+        try:
+            message = 'Tag %s renamed to %s.' % (old_title, tag.rename(new_title).title)
+        except ValueError as exc:
+            (message, status) = (str(exc), 400)
+    else:
+        (message, status) = ('Unknown action %s.' % action, 400)
+
+    if request.is_json:
+        return {'message': message}, status
+
+    flash(message, 'success' if status == 200 else 'danger')
+    return redirect(url_for('list_tags'))
 
 # in a flask route, anything <> is a variable and is passed on to the
 # function defining the route
 @app.route('/<slug>/')
+@cached_page
 def detail(slug):
     if session.get('logged_in'):
         query = Entry.select()
     else:
         query = Entry.public()
+    query = Entry.with_tags(query)
     # fairly self-defining  but I'm not sure what the 404 object is (TODO)
     entry = get_object_or_404(query, Entry.slug == slug)
-    return render_template('detail.html', entry=entry)
+
+    related = list(RelatedEntry.for_entry(entry.id, app.config['RELATED_POSTS']))
+    g.related_slugs = [e.slug for e in related]
+
+    # normally the stored copy; until the render job has stored one it's
+    # rendered here with any embeds that weren't fetched yet left out, that
+    # page mustn't be cached or validated since the job changes it
+    html = entry.html_content
+    if oembed_state.missed:
+        g.skip_response_cache = True
+        return render_template('detail.html', entry=entry, related=related, html=html)
+
+    # the html is part of the ETag, as `flask rerender` can change it without
+    # the entry being saved (after `flask oembed refresh`, say)
+    (etag, last_modified) = page_validators(
+        entry.updated_at, entry.id, hash_content(html),
+        [(e.id, e.title, e.slug) for e in related])
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+
+    return conditional_response(
+        render_template('detail.html', entry=entry, related=related, html=html),
+        etag, last_modified)
 
 @app.route('/<slug>/edit/', methods=['GET', 'POST'])
 @login_required
@@ -547,10 +3113,11 @@ def edit(slug):
             entry.save()
 
             tags = [t.strip() for t in request.form['tags'].split(',')]
-            (new_tags, new_entrytags) = entry.add_tags(*tags)
+            (new_tags, new_entrytags, removed_entrytags) = entry.set_tags(*tags)
 
             flash(str(new_tags) + " new tags were created." )
             flash(str(new_entrytags) + " new entry tag relationships were created." )
+            flash(str(removed_entrytags) + " entry tag relationships were removed." )
             flash('Entry saved successfully.', 'success')
             if entry.published:
                 return redirect(url_for('detail', slug=entry.slug))
@@ -577,14 +3144,648 @@ def delete(slug):
 
         return redirect(url_for('edit', slug=slug))
 
+##################
+# Static Export
+##################
+
+# `flask freeze` writes every page a logged out reader can see to FREEZE_DIR,
+# rendered by the app itself through a test client, so the copy is exactly
+# what the live site would serve
+# a page's url decides its file: /slug/ -> slug/index.html, /feed.xml ->
+# feed.xml, and the pages of the index and of each tag, which only differ by
+# their query string, go under _query/ named after it, e.g. /?t=python ->
+# _query/t=python.html (the README has the nginx config to match)
+FREEZE_QUERY_DIR = '_query'
+
+# kept in FREEZE_DIR, for every file it holds a digest of what the page was
+# made from ('inputs') and of the file itself ('hash'), so the next run only
+# renders pages whose entries, tags or templates changed and only rewrites
+# files that came out different
+FREEZE_MANIFEST = '.freeze.json'
+
+def freeze_path(url):
+    (path, _, query) = url.partition('?')
+    if query:
+        return '%s/%s.html' % (FREEZE_QUERY_DIR, query)
+    path = path.lstrip('/')
+    if not path or path.endswith('/'):
+        path += 'index.html'
+    return path
+
+def freeze_digest(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+# everything that every page depends on: the templates, the static file
+# names, the renderer and the settings that show up in the pages
+def freeze_site_signature(base_url):
+    templates = hashlib.sha1()
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    for (root, dirs, files) in os.walk(template_folder):
+        dirs.sort()
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            templates.update(os.path.relpath(path, template_folder).encode('utf-8'))
+            with open(path, 'rb') as f:
+                templates.update(f.read())
+
+    return freeze_digest(
+        templates.hexdigest(),
+        json.dumps(asset_manifest, sort_keys=True),
+        render_signature(),
+        base_url,
+        app.config['SITE_NAME'],
+        app.config['PAGINATE_BY'],
+        app.config['FEED_SIZE'])
+
+# the url of one page of a listing, built the same way as the links in
+# includes/pagination.html so the files match what the pages link to
+def listing_url(args, **cursor):
+    querystring = clean_querystring(dict(args, **cursor))
+    return url_for('index') + ('?' + querystring if querystring else '')
+
+# the pages of a listing of entries (newest first, as from Entry.cards),
+# following KeysetPage: page n is linked as ?before=<last entry of page n-1>
+# from the page after it, and as ?after=<first entry of page n+1> from the
+# page before it, both urls show the same entries so it's rendered once
+def freeze_listing(pages, entries, count, site, **args):
+    per_page = app.config['PAGINATE_BY']
+    chunks = [entries[i:i + per_page] for i in range(0, len(entries), per_page)] or [[]]
+
+    for (number, chunk) in enumerate(chunks):
+        has_newer = number > 0
+        has_older = number + 1 < len(chunks)
+
+        urls = []
+        if has_newer:
+            urls.append(listing_url(args, before=make_cursor(chunks[number - 1][-1])))
+        else:
+            urls.append(listing_url(args))
+        if has_older:
+            urls.append(listing_url(args, after=make_cursor(chunks[number + 1][0])))
+
+        shown = [(e.id, e.title, e.slug, e.summary, e.timestamp, e.tag_list)
+                 for e in chunk]
+        pages.append(dict(
+            url=urls[0], paths=[freeze_path(url) for url in urls], status=200,
+            inputs=freeze_digest(site, 'index', args, count, has_newer, has_older, shown)))
+
+# the pages to export, each with the url to render, the files it's written
+# to and a digest of what it shows, found with a few queries and no rendering
+# call inside a request context, for url_for
+def freeze_pages(base_url):
+    site = freeze_site_signature(base_url)
+    pages = []
+
+    def add(url, *parts, status=200, path=None):
+        pages.append(dict(url=url, paths=[path or freeze_path(url)], status=status,
+                          inputs=freeze_digest(site, url, *parts)))
+
+    add(url_for('about_me'))
+    # a slug can't have a dot in it, so this is always the 404 page
+    add('/404.html/', status=404, path='404.html')
+
+    # an entry's page changes when it is saved, its tags change or its html is
+    # rendered again (e.g. after `flask oembed refresh`)
+    entries = (Entry
+               .select(Entry.id, Entry.slug, Entry.title, Entry.timestamp,
+                       Entry.updated_at, EntryCard.tag_list, EntryRender.html)
+               .join(EntryCard, on=(EntryCard.entry == Entry.id))
+               .switch(Entry)
+               .join(EntryRender, JOIN.LEFT_OUTER, on=(EntryRender.entry == Entry.id))
+               .where(Entry.published == True)
+               .order_by(Entry.timestamp.desc(), Entry.id.desc())
+               .tuples())
+    # and when an entry in its related list is published, renamed or deleted
+    related = {}
+    query = (RelatedEntry
+             .select(RelatedEntry.entry, EntryCard.slug, EntryCard.title)
+             .join(EntryCard, on=(EntryCard.entry == RelatedEntry.related))
+             .where(EntryCard.published == True)
+             .order_by(RelatedEntry.entry, RelatedEntry.score.desc(),
+                       RelatedEntry.related.desc())
+             .tuples())
+    for (entry_id, slug, title) in query.iterator():
+        related.setdefault(entry_id, []).append((slug, title))
+
+    details = []
+    for row in entries.iterator():
+        shown = related.get(row[0], [])[:app.config['RELATED_POSTS']]
+        details.append((row[1], row[4], freeze_digest(row, shown)))
+        add(url_for('detail', slug=row[1]), details[-1][2])
+
+    cards = list(Entry.cards().order_by(EntryCard.timestamp.desc(), EntryCard.entry.desc()))
+    freeze_listing(pages, cards, len(cards), site)
+
+    # every tag that a published entry links to, in one query rather than a
+    # Tag.search for each
+    tagged = (Entry
+              .cards()
+              .join(EntryTag, on=(EntryTag.entry == EntryCard.entry))
+              .join(Tag)
+              .select_extend(Tag.title.alias('tag_title'))
+              .order_by(Tag.title, EntryCard.timestamp.desc(), EntryCard.entry.desc()))
+    for (tag, tag_entries) in itertools.groupby(tagged, lambda e: e.tag_title):
+        freeze_listing(pages, list(tag_entries), None, site, t=tag)
+
+    last_modified = max((updated_at for (_, updated_at, _) in details), default=None)
+    feed_entries = [digest for (_, _, digest) in details[:app.config['FEED_SIZE']]]
+    for feed_format in ('atom', 'rss'):
+        add(url_for('feed', feed_format=feed_format),
+            len(details), last_modified, feed_entries)
+
+    add(url_for('sitemap'), [(slug, updated_at) for (slug, updated_at, _) in details])
+
+    cloud = list(Tag.cloud().tuples())
+    add(url_for('list_tags'), cloud)
+    add(url_for('tags_json'), cloud)
+
+    return pages
+
+# writes a file so that a reader never sees half of it
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+# renders one page and writes it to each of its files that doesn't already
+# hold the same content, returns the content's hash and the files written
+# run in the worker processes, so everything it needs is passed in
+def freeze_page(output_dir, base_url, url, paths, status, hashes):
+    response = app.test_client().get(url, base_url=base_url)
+    if response.status_code != status:
+        raise RuntimeError('%s returned %s' % (url, response.status_code))
+
+    data = response.get_data()
+    digest = hashlib.sha1(data).hexdigest()
+    written = 0
+    for (path, old_hash) in zip(paths, hashes):
+        target = os.path.join(output_dir, path)
+        if old_hash != digest or not os.path.exists(target):
+            write_file(target, data)
+            written += 1
+    return (digest, written)
+
+# each worker opens its own connections; the pages only read, so the job
+# queue's threads aren't needed
+def start_freeze_worker():
+    app.config['JOB_WORKERS'] = 0
+
+# an open sqlite connection mustn't be used by a forked process, so the pools
+# are emptied before the workers start and they open their own
+def close_database_connections():
+    for db in (database.obj, read_database):
+        if not db.is_closed():
+            db.close()
+        if hasattr(db, 'close_all'):
+            db.close_all()
+
+# brings output_dir up to date with the site and returns counts of the pages
+# rendered, files written and files removed
+# workers -- processes rendering pages, 0 or 1 renders them in this process
+# force -- render every page, e.g. after changing app.py
+def freeze_site(output_dir, base_url, workers=None, force=False):
+    manifest_path = os.path.join(output_dir, FREEZE_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            previous = json.load(f)['files']
+    except (OSError, ValueError, KeyError):
+        previous = {}
+
+    files = {}
+    stats = {'rendered': 0, 'written': 0, 'removed': 0, 'failed': []}
+
+    def is_current(path, inputs):
+        return (not force and path in previous and
+                previous[path]['inputs'] == inputs and
+                os.path.exists(os.path.join(output_dir, path)))
+
+    # static files are copied as they are, a changed file has a new mtime
+    for (root, dirs, filenames) in os.walk(app.static_folder):
+        for filename in filenames:
+            source = os.path.join(root, filename)
+            path = 'static/' + os.path.relpath(source, app.static_folder).replace(os.sep, '/')
+            stat = os.stat(source)
+            inputs = freeze_digest(stat.st_size, stat.st_mtime_ns)
+            if not is_current(path, inputs):
+                target = os.path.join(output_dir, path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(source, target + '.tmp')
+                os.replace(target + '.tmp', target)
+                stats['written'] += 1
+            files[path] = {'inputs': inputs, 'hash': inputs}
+
+    with app.test_request_context():
+        pages = freeze_pages(base_url)
+
+    tasks = []
+    for page in pages:
+        if all(is_current(path, page['inputs']) for path in page['paths']):
+            for path in page['paths']:
+                files[path] = previous[path]
+        else:
+            hashes = [previous.get(path, {}).get('hash') for path in page['paths']]
+            tasks.append((page, (output_dir, base_url, page['url'], page['paths'],
+                                 page['status'], hashes)))
+
+    def finished(page, result=None, error=None):
+        if error is not None:
+            # whatever was there is kept, and tried again next time
+            stats['failed'].append('%s: %s' % (page['url'], error))
+            for path in page['paths']:
+                if path in previous:
+                    files[path] = dict(previous[path], inputs=None)
+            return
+        (digest, written) = result
+        stats['rendered'] += 1
+        stats['written'] += written
+        for path in page['paths']:
+            files[path] = {'inputs': page['inputs'], 'hash': digest}
+
+    if len(tasks) > 1 and (workers is None or workers > 1):
+        close_database_connections()
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=start_freeze_worker) as executor:
+            futures = dict((executor.submit(freeze_page, *args), page)
+                           for (page, args) in tasks)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    finished(futures[future], future.result())
+                except Exception as exc:
+                    finished(futures[future], error=exc)
+    else:
+        for (page, args) in tasks:
+            try:
+                finished(page, freeze_page(*args))
+            except Exception as exc:
+                finished(page, error=exc)
+
+    # files from earlier runs that no page writes any more (a deleted entry,
+    # a tag with nothing left in it), along with directories left empty
+    for path in set(previous) - set(files):
+        target = os.path.join(output_dir, path)
+        if os.path.exists(target):
+            os.remove(target)
+            stats['removed'] += 1
+        directory = os.path.dirname(target)
+        while (os.path.abspath(directory) != os.path.abspath(output_dir)
+               and os.path.isdir(directory) and not os.listdir(directory)):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    write_file(manifest_path, json.dumps({'files': files}, sort_keys=True).encode('utf-8'))
+    return stats
+
+
+##################
+# Commands
+##################
+
+# the other commands leave creating and changing the tables to `flask migrate`
+# too, e.g. `flask jobs run` from a scheduled task mustn't rebuild anything
+def require_current_schema():
+    if not schema_is_current():
+        raise click.ClickException('The database is out of date, run `flask migrate`.')
+
+# run with `flask migrate` to create or update the tables in blog.db
+@app.cli.command('migrate')
+def migrate_command():
+    migrate_database()
+    click.echo('Database is up to date.')
+
+# run with `flask freeze` to write the site to FREEZE_DIR, see Static Export
+# only pages whose entries, tags or templates changed are rendered again,
+# use --force after changing the code
+@app.cli.command('freeze')
+@click.option('--output', help='Directory to write to (default: FREEZE_DIR).')
+@click.option('--base-url', help='Address the copy is served from (default: FREEZE_BASE_URL).')
+@click.option('--workers', type=int, help='Processes rendering pages (default: FREEZE_WORKERS).')
+@click.option('--force', is_flag=True, help='Render every page.')
+def freeze(output, base_url, workers, force):
+    if workers is None:
+        workers = app.config['FREEZE_WORKERS']
+    stats = freeze_site(
+        output or app.config['FREEZE_DIR'],
+        base_url or app.config['FREEZE_BASE_URL'],
+        workers, force)
+
+    click.echo('%(rendered)s pages rendered, %(written)s files written, '
+               '%(removed)s removed.' % stats)
+    if stats['failed']:
+        raise click.ClickException(
+            '%s pages failed:\n%s' % (len(stats['failed']), '\n'.join(stats['failed'])))
+
+# run with `flask rerender`, usually after upgrading markdown or pygments
+# --force re-renders entries even if their stored html looks current
+@app.cli.command('rerender')
+@click.option('--force', is_flag=True, help='Re-render every entry.')
+def rerender(force):
+    require_current_schema()
+
+    # one entry at a time and outside of a transaction, embeds may be fetched
+    # over the network and holding the write lock meanwhile would make saves
+    # on the running site time out
+    entry_ids = [entry_id for (entry_id,) in Entry.select(Entry.id).tuples()]
+    count = changed = 0
+    for entry_id in entry_ids:
+        entry = Entry.get_or_none(Entry.id == entry_id)
+        if entry is None:
+            continue
+
+        previous = (EntryRender
+                    .select(EntryRender.html)
+                    .where(EntryRender.entry == entry_id)
+                    .scalar())
+        with fetching_oembeds():
+            html = entry.update_rendered_html(force=force)
+        count += 1
+
+        # the running site drops its copies too, see SharedResponseCache
+        if html != previous:
+            entry.purge_cached_pages(entry.get_tags())
+            changed += 1
+
+    prune_render_caches()
+    click.echo('%s entries checked, %s changed.' % (count, changed))
+
+# run with `flask oembed refresh` from a scheduled task, fetches expired
+# oembed responses again and drops the oldest ones past OEMBED_CACHE_SIZE
+# entries that use a changed embed pick it up with `flask rerender --force`
+@app.cli.group('oembed')
+def oembed():
+    """Maintain the stored oembed responses."""
+
+@oembed.command('refresh')
+def oembed_refresh():
+    require_current_schema()
+    expired = list(OEmbedResponse
+                   .select()
+                   .where(OEmbedResponse.expires <= datetime.datetime.now()))
+    renderer = get_renderer()
+    with fetching_oembeds():
+        for response in expired:
+            try:
+                renderer.oembed_providers.request(response.url, **json.loads(response.params))
+            except renderer.ProviderException:
+                pass
+    removed = OEmbedResponse.prune(app.config['OEMBED_CACHE_SIZE'])
+    click.echo('%s responses refreshed, %s removed.' % (len(expired), removed))
+
+# run with `flask jobs run|status|retry`
+# `run` works through the queue in the foreground and exits, for hosts where
+# the app has JOB_WORKERS set to 0 and a scheduled task picks up the retries
+@app.cli.group('jobs')
+def jobs():
+    """Inspect and run the background job queue."""
+
+@jobs.command('run')
+def jobs_run():
+    require_current_schema()
+    count = 0
+    while job_queue.run_next():
+        count += 1
+    click.echo('%s jobs run.' % count)
+
+@jobs.command('status')
+def jobs_status():
+    counts = (Job
+              .select(Job.status, fn.COUNT(Job.id).alias('count'))
+              .group_by(Job.status)
+              .tuples())
+    for (status, count) in counts:
+        click.echo('%s: %s' % (status, count))
+    for job in Job.select().where(Job.status == 'failed').order_by(Job.id):
+        click.echo('failed: job %s (%s %s) %s' % (job.id, job.kind, job.payload, job.error))
+
+# queues the failed jobs again with a fresh set of attempts
+@jobs.command('retry')
+def jobs_retry():
+    count = (Job
+             .update(status='queued', attempts=0, run_after=datetime.datetime.now(),
+                     finished_at=None)
+             .where(Job.status == 'failed')
+             .execute())
+    click.echo('%s jobs queued again.' % count)
+
+# run with `flask assets build` when deploying, see ASSETS_DIR
+# --clean removes hashed copies from earlier builds, leave them while pages
+# linking them may still be cached somewhere
+@app.cli.group('assets')
+def assets():
+    """Build the fingerprinted static files."""
+
+@assets.command('build')
+@click.option('--clean', is_flag=True, help='Remove files from earlier builds.')
+def assets_build(clean):
+    build_dir = app.config['ASSETS_DIR']
+    manifest = build_assets(app.static_folder, build_dir)
+
+    removed = 0
+    if clean:
+        keep = set()
+        for asset in manifest.values():
+            keep.add(asset['path'])
+            keep.update(asset['path'] + suffix for suffix in ('.gz', '.br'))
+        for (root, _, files) in os.walk(os.path.join(app.static_folder, build_dir)):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+                if name not in keep and filename != 'manifest.json':
+                    os.remove(path)
+                    removed += 1
+
+    click.echo('%s files built, %s old files removed.' % (len(manifest), removed))
+
+# run with `flask related rebuild`
+@app.cli.group('related')
+def related_entries():
+    """Manage the related entries."""
+
+# works out every entry's related entries again, e.g. after changing RELATED_KEPT
+@related_entries.command('rebuild')
+def related_rebuild():
+    with database.atomic('IMMEDIATE'):
+        RelatedEntry.rebuild()
+    click.echo('Related entries rebuilt.')
+
+# run with `flask search-index rebuild|optimize|check`
+@app.cli.group('search-index')
+def search_index():
+    """Maintain the full-text search index."""
+
+@search_index.command('rebuild')
+def search_index_rebuild():
+    with database.atomic('IMMEDIATE'):
+        FTSEntry.rebuild()
+    click.echo('Search index rebuilt.')
+
+@search_index.command('optimize')
+def search_index_optimize():
+    FTSEntry.optimize()
+    click.echo('Search index optimized.')
+
+# exits with status 1 if anything is out of date, so it can be scripted
+@search_index.command('check')
+def search_index_check():
+    (missing, stale) = FTSEntry.check()
+    for entry_id in missing:
+        click.echo('missing: entry %s is not in the search index' % entry_id)
+    for entry_id in stale:
+        click.echo('stale: entry %s is indexed with old content' % entry_id)
+    if missing or stale:
+        click.echo('Run `flask search-index rebuild` to fix the index.')
+        raise SystemExit(1)
+    click.echo('Search index is up to date.')
+
 ##################
 # App Initialization
 ##################
 
+# stored in blog.db by migrate_database, bump it whenever that changes so
+# the app can tell `flask migrate` hasn't been run since
+SCHEMA_VERSION = 7
+
+# false until `flask migrate` has brought the tables up to date
+def schema_is_current():
+    return database.pragma('user_version') >= SCHEMA_VERSION
+
+# brings an existing blog.db up to date with the models, create_tables only
+# creates missing tables and won't add columns to the ones that exist
+# run by `flask migrate` rather than on startup, so starting the app never
+# waits on (or locks) the database
+def migrate_database():
+    migrator = SqliteMigrator(database)
+
+    # the search index used to be a single column FTS4 table, and then a FTS5
+    # table holding its own copy of the text, either is dropped and built
+    # again from the entries
+    rebuild_search_index = False
+    if database.table_exists('ftsentry'):
+        (sql,) = database.execute_sql(
+            "SELECT sql FROM sqlite_master WHERE name = 'ftsentry'").fetchone()
+        if 'content_rowid' not in sql:
+            FTSEntry.drop_table()
+            rebuild_search_index = True
+
+    # before the unique index on entrytag existed an entry could be linked to
+    # a tag more than once, only the first link is kept
+    if database.table_exists('entrytag'):
+        indexes = [index.name for index in database.get_indexes('entrytag')]
+        if 'entrytag_entry_id_tag_id' not in indexes:
+            database.execute_sql(
+                'DELETE FROM entrytag WHERE id NOT IN ('
+                'SELECT MIN(id) FROM entrytag GROUP BY entry_id, tag_id)')
+
+    # columns have to be added before create_tables runs, since it also
+    # creates the indexes on them
+    if database.table_exists('entry'):
+        columns = [column.name for column in database.get_columns('entry')]
+
+        if 'updated_at' not in columns:
+            with database.atomic('IMMEDIATE'):
+                migrate(migrator.add_column('entry', 'updated_at', DateTimeField(null=True)))
+                Entry.update(updated_at=Entry.timestamp).execute()
+
+    # the counts are worked out once the triggers that keep them exist
+    recount_tags = False
+    if database.table_exists('tag'):
+        columns = [column.name for column in database.get_columns('tag')]
+
+        # the migrator would copy the whole table over to make the column
+        # NOT NULL, which the card triggers on tag don't survive, a plain
+        # ALTER TABLE can add it in place since it has a default
+        if 'entry_count' not in columns:
+            database.execute_sql(
+                'ALTER TABLE tag ADD COLUMN entry_count INTEGER NOT NULL DEFAULT 0')
+            recount_tags = True
+
+    # the listing, count and related tables are filled from the entries the
+    # first time they're created
+    build_cards = not database.table_exists('entrycard')
+    count_entries = not database.table_exists('entrycount')
+    build_related = not database.table_exists('relatedentry')
+
+    # create tables (and their indexes) if they don't already exist
+    database.create_tables([Entry, FTSEntry, EntryRender, OEmbedResponse,
+                            HighlightedBlock, CacheInvalidation, Tag, EntryTag,
+                            EntryCard, EntryCount, RelatedEntry, Job])
+
+    for trigger in (SEARCH_TRIGGERS + CARD_TRIGGERS + TAG_COUNT_TRIGGERS +
+                    ENTRY_COUNT_TRIGGERS):
+        database.execute_sql(trigger)
+
+    if recount_tags:
+        with database.atomic('IMMEDIATE'):
+            Tag.recount()
+
+    if build_cards:
+        with database.atomic('IMMEDIATE'):
+            EntryCard.rebuild()
+
+    if count_entries:
+        with database.atomic('IMMEDIATE'):
+            EntryCount.recount()
+
+    if build_related:
+        with database.atomic('IMMEDIATE'):
+            RelatedEntry.rebuild()
+
+    # stored in the FTS table, so searches can ORDER BY rank
+    FTSEntry.set_rank('bm25(%s, %s)' % (
+        float(app.config['SEARCH_TITLE_WEIGHT']),
+        float(app.config['SEARCH_CONTENT_WEIGHT'])))
+
+    if rebuild_search_index:
+        FTSEntry.rebuild()
+
+    database.pragma('user_version', SCHEMA_VERSION)
+
+# sets up everything that depends on the config: the database, the response
+# cache and the static file manifest; nothing here connects to the database
+# or imports the rendering libraries, so starting a worker stays quick
+def configure_app():
+    global read_database, response_cache
+
+    if database.obj is not None and not database.is_closed():
+        database.close()
+    database.initialize(open_database(app.config['DATABASE']))
+    instrument_database(database.obj)
+    read_database = open_database(app.config['DATABASE'], read_only=True)
+
+    if app.config['RESPONSE_CACHE_SIZE'] > 0:
+        cache_class = (SharedResponseCache if app.config['RESPONSE_CACHE_SHARED']
+                       else LRUResponseCache)
+        response_cache = cache_class(
+            app.config['RESPONSE_CACHE_SIZE'],
+            app.config['RESPONSE_CACHE_TTL'])
+    else:
+        response_cache = ResponseCache()
+
+    manifest = load_asset_manifest()
+    asset_manifest.clear()
+    asset_manifest.update(manifest)
+    asset_encodings.clear()
+    asset_encodings.update(
+        (asset['path'], asset['encodings']) for asset in manifest.values())
+
+configure_app()
+
+# returns the app for a WSGI server or a script, see wsgi.py
+# config -- settings to use instead of the ones above (and BLOG_SETTINGS),
+#   e.g. {'DATABASE': {...}}, given before the app handles any requests
+# the routes and models are declared against the one module level app, so
+# this configures that app rather than building a new one each time
+def create_app(config=None):
+    if config:
+        app.config.update(config)
+        configure_app()
+    return app
+
+# the development server, run with `python app.py` (after `flask migrate`)
+# set DEBUG = True in a BLOG_SETTINGS file for the debugger and reloader
+# in production the app is served by a WSGI server from wsgi.py instead
 def main():
-    # create tables if they don't already exist
-    database.create_tables([Entry, FTSEntry, Tag, EntryTag])
-    app.run(debug=True, host='0.0.0.0')
+    create_app().run(debug=app.config['DEBUG'], host='0.0.0.0')
 
 # hooo
 if __name__ == '__main__':
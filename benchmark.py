@@ -0,0 +1,330 @@
+
+#
+# Benchmarks the blog's busiest routes against a synthetic database.
+#
+# Builds a blog.db with a given number of entries (with tags, code blocks and
+# embedded links like the real thing), then drives the routes through the
+# flask test client and reports throughput, p50/p99 latency and the number of
+# SQL queries for each. Results can be saved as a json baseline and compared
+# against later runs:
+#
+#   python benchmark.py --entries 10000 --save baseline.json
+#   python benchmark.py --entries 10000 --compare baseline.json
+#
+# It also times how long a fresh process takes to import and create the app,
+# which is what every recycled worker pays before it can answer a request;
+# --startup-budget makes it exit with status 1 when that is over budget.
+#
+# oembed providers are replaced with a local stand in, so nothing here uses
+# the network.
+#
+
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CODE_SNIPPETS = (
+    ('python', 'def {0}(items):\n    total = 0\n    for item in items:\n        total += item.{1}\n    return total\n'),
+    ('javascript', 'function {0}(el) {{\n  const {1} = el.querySelectorAll("li");\n  return {1}.length;\n}}\n'),
+    ('bash', 'for f in *.{1}; do\n  echo "$f"\n  {0} "$f"\ndone\n'),
+    ('sql', 'SELECT {1}, COUNT(*)\nFROM {0}\nGROUP BY {1}\nORDER BY 2 DESC;\n'),
+)
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ren', 'to', 'sa', 'vel', 'qui', 'dor', 'an',
+             'pe', 'lu', 'nis', 'gar', 'o', 'ti', 'mer', 'zu', 'bel', 'ca')
+
+
+##################
+# Synthetic Data
+##################
+
+def make_words(rng, count):
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+# tag popularity roughly follows a power law, a few tags are on most entries
+def pick_tags(rng, tags, weights):
+    count = rng.randint(1, 5)
+    return list(set(rng.choices(tags, weights=weights, k=count)))
+
+def make_content(rng, words):
+    parts = []
+    for _ in range(rng.randint(3, 8)):
+        parts.append(' '.join(rng.choice(words) for _ in range(rng.randint(40, 120))) + '.')
+
+        if rng.random() < 0.3:
+            (lang, template) = rng.choice(CODE_SNIPPETS)
+            code = template.format(rng.choice(words), rng.choice(words))
+            parts.append('```%s\n%s```' % (lang, code * rng.randint(1, 4)))
+
+    if rng.random() < 0.2:
+        parts.insert(rng.randint(1, len(parts)),
+                     'https://www.youtube.com/watch?v=%s' % rng.choice(words))
+
+    return '\n\n'.join(parts)
+
+# the same words are used for the content and for the searches
+def vocabulary(seed):
+    return make_words(random.Random(seed), 2000)
+
+def build_database(blog, entries, seed, prerender):
+    rng = random.Random(seed)
+    words = vocabulary(seed)
+    tags = make_words(rng, 200)
+    weights = [1.0 / rank for rank in range(1, len(tags) + 1)]
+    start = datetime.datetime(2015, 1, 1)
+
+    batch = []
+    for i in range(entries):
+        title = '%s %s' % (' '.join(rng.choice(words) for _ in range(rng.randint(2, 6))), i)
+        entry = blog.Entry(
+            title=title.capitalize(),
+            content=make_content(rng, words),
+            published=rng.random() < 0.9,
+            timestamp=start + datetime.timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 6)))
+        batch.append((entry, pick_tags(rng, tags, weights)))
+
+        if len(batch) == 1000:
+            blog.Entry.import_many(batch)
+            batch = []
+            print('  %s / %s entries' % (i + 1, entries), file=sys.stderr)
+    if batch:
+        blog.Entry.import_many(batch)
+
+    # import_many queues a render job for every entry, they are either run
+    # here (alongside the app's own workers) or thrown away
+    if prerender:
+        rendered = 0
+        while blog.job_queue.run_next():
+            rendered += 1
+            if rendered % 1000 == 0:
+                print('  %s rendered' % rendered, file=sys.stderr)
+    else:
+        blog.Job.delete().execute()
+
+    blog.database.close()
+
+
+##################
+# Scenarios
+##################
+
+# each scenario makes one request and returns the response
+class Scenarios(object):
+
+    def __init__(self, blog, seed):
+        self.blog = blog
+        self.rng = random.Random(seed)
+        self.client = blog.app.test_client()
+        self.admin = blog.app.test_client()
+        with self.admin.session_transaction() as session:
+            session['logged_in'] = True
+
+        with blog.database.connection_context():
+            entries = list(blog.Entry
+                           .select(blog.Entry.id, blog.Entry.slug, blog.Entry.timestamp)
+                           .where(blog.Entry.published == True))
+            self.slugs = [e.slug for e in entries]
+            self.cursors = [blog.make_cursor(e) for e in entries]
+            self.tags = [t.title for t in blog.Tag.select(blog.Tag.title)]
+        self.words = vocabulary(seed)
+        self.created = 0
+
+    def index(self):
+        return self.client.get('/')
+
+    def index_deep(self):
+        return self.client.get('/', query_string={'before': self.rng.choice(self.cursors)})
+
+    def detail(self):
+        return self.client.get('/%s/' % self.rng.choice(self.slugs))
+
+    def search(self):
+        return self.client.get('/', query_string={'q': self.rng.choice(self.words)})
+
+    def tag_search(self):
+        return self.client.get('/', query_string={'t': self.rng.choice(self.tags)})
+
+    def create(self):
+        self.created += 1
+        return self.admin.post('/create/', data={
+            'title': 'Benchmark post %s %s' % (self.created, self.rng.random()),
+            'content': make_content(self.rng, self.words),
+            'published': 'y',
+            'tags': ', '.join(self.rng.sample(self.tags, 3))})
+
+    def edit(self):
+        slug = self.rng.choice(self.slugs)
+        return self.admin.post('/%s/edit/' % slug, data={
+            'title': slug,
+            'content': make_content(self.rng, self.words),
+            'published': 'y',
+            'tags': ', '.join(self.rng.sample(self.tags, 3))})
+
+    def upload(self):
+        self.created += 1
+        content = make_content(self.rng, self.words).encode('utf-8')
+        return self.admin.post(
+            '/upload/',
+            headers={'User-Agent': self.blog.app.config['UPLOADER_USER_AGENT']},
+            data={
+                'title': 'Uploaded post %s %s' % (self.created, self.rng.random()),
+                'published': 'True',
+                'uploaded_file': (io.BytesIO(content), 'post.md')})
+
+SCENARIOS = ('index', 'index_deep', 'detail', 'search', 'tag_search', 'create', 'edit', 'upload')
+
+
+##################
+# Running
+##################
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+def run_scenario(blog, scenarios, name, requests):
+    request = getattr(scenarios, name)
+    latencies = []
+    queries = []
+    errors = 0
+
+    # one request first so nothing is measured cold
+    request()
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = request()
+        latencies.append(time.perf_counter() - start)
+        queries.append(blog.stage_state.queries)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': requests / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'queries': statistics.mean(queries),
+    }
+
+def print_results(results, baseline=None):
+    columns = ('throughput', 'p50_ms', 'p99_ms', 'queries')
+    print('%-12s %12s %10s %10s %8s %7s' % (('scenario',) + columns + ('errors',)))
+    for (name, result) in results.items():
+        print('%-12s %12.1f %10.2f %10.2f %8.1f %7d' % (
+            (name,) + tuple(result[c] for c in columns) + (result['errors'],)))
+
+        previous = (baseline or {}).get(name)
+        if previous:
+            changes = []
+            for (c, width) in zip(columns, (12, 10, 10, 8)):
+                if previous[c]:
+                    change = '%+.1f%%' % ((result[c] - previous[c]) / previous[c] * 100)
+                else:
+                    change = '-'
+                changes.append(change.rjust(width))
+            print('%-12s %s' % ('  vs base', ' '.join(changes)))
+
+# median milliseconds taken to import and create the app in a new interpreter
+def measure_startup(runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-c', 'import app; app.create_app()'],
+            cwd=APP_DIR, check=True)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=1000,
+                        help='entries in the synthetic database (e.g. 1000, 10000, 100000)')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated list of: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--database', help='path of the synthetic database, it is built '
+                        'if it does not exist (default: a file named for --entries)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cache', action='store_true', help='leave the response cache on')
+    parser.add_argument('--no-prerender', action='store_true',
+                        help='leave entries unrendered, as after a bulk upload')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--compare', help='json file from --save to compare against')
+    parser.add_argument('--startup-runs', type=int, default=10,
+                        help='fresh processes started to time startup')
+    parser.add_argument('--startup-budget', type=float,
+                        help='milliseconds the median startup may take')
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.database or 'benchmark-%s.db' % args.entries)
+
+    print('timing startup', file=sys.stderr)
+    startup = measure_startup(args.startup_runs)
+
+    sys.path.insert(0, APP_DIR)
+    import app as blog
+    blog.create_app({
+        'DATABASE': dict(blog.DATABASE, name=path),
+        'OEMBED_OFFLINE': True,
+        'RESPONSE_CACHE_SIZE': 500 if args.cache else 0,
+    })
+
+    # an existing database is brought up to date first, like on a deploy
+    build = not os.path.exists(path)
+    blog.migrate_database()
+    if build:
+        print('building %s' % path, file=sys.stderr)
+        build_database(blog, args.entries, args.seed, not args.no_prerender)
+
+    scenarios = Scenarios(blog, args.seed)
+    results = {}
+    for name in args.scenarios.split(','):
+        print('running %s' % name, file=sys.stderr)
+        results[name] = run_scenario(blog, scenarios, name, args.requests)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline.get('results'))
+
+    line = 'startup: %.1f ms' % startup
+    if baseline.get('startup_ms'):
+        line += ' (%+.1f%% vs base)' % (
+            (startup - baseline['startup_ms']) / baseline['startup_ms'] * 100)
+    print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'entries': args.entries,
+                'requests': args.requests,
+                'seed': args.seed,
+                'cache': args.cache,
+                'results': results,
+                'startup_ms': startup,
+            }, f, indent=2, sort_keys=True)
+
+    if args.startup_budget and startup > args.startup_budget:
+        print('startup is over the %.0f ms budget' % args.startup_budget, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+import pytest
+
+from support import blog, create_app, log_in
+
+
+@pytest.fixture
+def app(tmp_path):
+    yield create_app(str(tmp_path / 'blog.db'))
+    if not blog.database.is_closed():
+        blog.database.close()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def admin(app):
+    return log_in(app.test_client())
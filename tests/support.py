@@ -0,0 +1,62 @@
+#
+# Shared by the tests and by the processes some of them start, which don't
+# run conftest.py.
+#
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# app.py reads the admin password and session key from secret.py, which
+# isn't checked in; the tests log in by setting the session instead
+try:
+    import secret
+except ImportError:
+    secret = types.ModuleType('secret')
+    secret.SECRET_KEY = b'tests'
+    sys.modules['secret'] = secret
+
+import app as blog
+
+# every test starts from the config app.py (and BLOG_SETTINGS) sets up
+DEFAULT_CONFIG = dict(blog.app.config)
+
+# points the app at a fresh database, with jobs run inline so that a request
+# has finished everything it queued by the time it returns
+def create_app(database_path, **config):
+    settings = dict(DEFAULT_CONFIG)
+    settings.update({
+        'DATABASE': dict(DEFAULT_CONFIG['DATABASE'], name=database_path),
+        'JOB_WORKERS': 0,
+        'OEMBED_OFFLINE': True,
+        'TESTING': True,
+    })
+    settings.update(config)
+    blog.create_app(settings)
+    blog.migrate_database()
+    blog.database.close()
+    return blog.app
+
+def log_in(client):
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
+
+# the body of a worker process for the tests that need several, like
+# gunicorn's: its own app, database connections and copy of the response
+# cache, sharing only the database file with the others
+# requests -- (logged_in, method, url, form data) tuples, None to stop
+# responses -- a (status code, body) tuple for each request
+def serve(database_path, config, requests, responses):
+    app = create_app(database_path, **config)
+    clients = {
+        False: app.test_client(),
+        True: log_in(app.test_client()),
+    }
+    for (logged_in, method, url, data) in iter(requests.get, None):
+        response = clients[logged_in].open(url, method=method, data=data)
+        responses.put((response.status_code, response.get_data(as_text=True)))
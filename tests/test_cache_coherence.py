@@ -0,0 +1,117 @@
+#
+# Each worker process keeps its own copy of the response cache, a write
+# handled by one has to drop the pages the others stored (see
+# SharedResponseCache) or they keep serving them until they expire.
+#
+
+import multiprocessing
+
+import pytest
+
+import support
+from support import create_app
+
+
+class Worker(object):
+
+    def __init__(self, database_path, **config):
+        context = multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.responses = context.Queue()
+        self.process = context.Process(
+            target=support.serve,
+            args=(database_path, config, self.requests, self.responses))
+        self.process.start()
+
+    def request(self, url, method='GET', data=None, logged_in=False):
+        self.requests.put((logged_in, method, url, data))
+        return self.responses.get(timeout=60)
+
+    def get(self, url):
+        (status, body) = self.request(url)
+        assert status == 200
+        return body
+
+    def post(self, url, data):
+        (status, body) = self.request(url, 'POST', data, logged_in=True)
+        assert status in (200, 302)
+        return body
+
+    def stop(self):
+        self.requests.put(None)
+        self.process.join(timeout=60)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+@pytest.fixture
+def workers(tmp_path):
+    database_path = str(tmp_path / 'blog.db')
+    create_app(database_path)
+
+    workers = [Worker(database_path), Worker(database_path)]
+    yield workers
+    for worker in workers:
+        worker.stop()
+
+# the pages the reader has stored in its cache, fetched twice so that the
+# second copy comes from it
+def warm(reader, urls):
+    for url in urls:
+        reader.get(url)
+        reader.get(url)
+
+def test_edits_are_seen_by_other_workers(workers):
+    (writer, reader) = workers
+    writer.post('/create/', {'title': 'Post', 'content': 'first', 'published': 'y',
+                             'tags': 'python, flask'})
+
+    urls = ['/post/', '/', '/?t=python', '/?t=flask']
+    for revision in range(1, 6):
+        warm(reader, urls)
+        writer.post('/post/edit/', {'title': 'Post',
+                                    'content': 'revision %d' % revision,
+                                    'published': 'y', 'tags': 'python, flask'})
+        assert 'revision %d' % revision in reader.get('/post/')
+
+        # the listings show the summary, which is made from the content
+        for url in urls[1:]:
+            assert 'revision %d' % revision in reader.get(url)
+
+def test_tag_changes_are_seen_by_other_workers(workers):
+    (writer, reader) = workers
+    writer.post('/create/', {'title': 'Post', 'content': 'text', 'published': 'y',
+                             'tags': 'python, flask'})
+
+    urls = ['/post/', '/?t=python', '/tags/']
+    warm(reader, urls)
+    writer.post('/tags/', {'action': 'rename', 'tag_title': 'flask', 'new_title': 'bottle'})
+    for url in urls:
+        body = reader.get(url)
+        assert 't=bottle' in body
+        assert 't=flask' not in body
+
+def test_deletes_are_seen_by_other_workers(workers):
+    (writer, reader) = workers
+    for title in ('Kept', 'Deleted'):
+        writer.post('/create/', {'title': title, 'content': 'text', 'published': 'y',
+                                 'tags': 'python'})
+
+    warm(reader, ['/deleted/', '/', '/?t=python'])
+    writer.post('/deleted/delete/', {})
+    assert reader.request('/deleted/')[0] == 404
+    for url in ('/', '/?t=python'):
+        body = reader.get(url)
+        assert 'Kept' in body
+        assert 'Deleted' not in body
+
+def test_unpublishing_is_seen_by_other_workers(workers):
+    (writer, reader) = workers
+    writer.post('/create/', {'title': 'Post', 'content': 'text', 'published': 'y',
+                             'tags': 'python'})
+
+    warm(reader, ['/post/', '/', '/feed.xml'])
+    writer.post('/post/edit/', {'title': 'Post', 'content': 'text', 'tags': 'python'})
+    assert reader.request('/post/')[0] == 404
+    assert '/post/' not in reader.get('/')
+    assert '/post/' not in reader.get('/feed.xml')
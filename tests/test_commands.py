@@ -0,0 +1,26 @@
+#
+# Only `flask migrate` changes the tables, the other commands refuse to run
+# against a database it hasn't brought up to date.
+#
+
+import pytest
+
+from support import blog
+
+
+@pytest.mark.parametrize('command', [['jobs', 'run'], ['rerender'], ['oembed', 'refresh']])
+def test_commands_need_a_migrated_database(app, command):
+    with blog.database.connection_context():
+        blog.database.pragma('user_version', blog.SCHEMA_VERSION - 1)
+
+    result = app.test_cli_runner().invoke(args=command)
+    assert result.exit_code != 0
+    assert 'flask migrate' in result.output
+
+    with blog.database.connection_context():
+        assert blog.database.pragma('user_version') == blog.SCHEMA_VERSION - 1
+
+def test_jobs_run(app):
+    result = app.test_cli_runner().invoke(args=['jobs', 'run'])
+    assert result.exit_code == 0
+    assert '0 jobs run.' in result.output
@@ -0,0 +1,65 @@
+#
+# The counts kept by triggers (EntryCount and Tag.entry_count) have to match
+# counting the entries, whatever happened to them.
+#
+
+import random
+
+from support import blog
+
+
+def counted():
+    entries = dict(
+        (published, blog.Entry.select().where(blog.Entry.published == published).count())
+        for published in (True, False))
+    tags = dict(blog.database.execute_sql(
+        'SELECT tag.id, (SELECT COUNT(*) FROM entrytag '
+        'JOIN entry ON entry.id = entrytag.entry_id '
+        'WHERE entrytag.tag_id = tag.id AND entry.published) FROM tag').fetchall())
+    return (entries, tags)
+
+def kept():
+    entries = dict((published, blog.EntryCount.total(published)) for published in (True, False))
+    tags = dict(blog.Tag.select(blog.Tag.id, blog.Tag.entry_count).tuples())
+    return (entries, tags)
+
+def test_counts_follow_changes(app):
+    rng = random.Random(1)
+    titles = ['t%d' % i for i in range(5)]
+    with blog.database.connection_context():
+        blog.Entry.import_many([
+            (blog.Entry(title='Imported %d' % i, content='text', published=i % 2 == 0),
+             rng.sample(titles, 2))
+            for i in range(10)])
+        assert kept() == counted()
+
+        for step in range(100):
+            entries = list(blog.Entry.select())
+            action = rng.random()
+            if action < 0.2 or not entries:
+                entry = blog.Entry.create(title='Entry %d' % step, content='text',
+                                          published=rng.random() < 0.5)
+                entry.add_tags(*rng.sample(titles, 2))
+            elif action < 0.5:
+                entry = rng.choice(entries)
+                entry.published = not entry.published
+                entry.save()
+            elif action < 0.7:
+                rng.choice(entries).set_tags(*rng.sample(titles, rng.randint(0, 3)))
+            elif action < 0.8:
+                rng.choice(entries).delete_instance()
+            else:
+                tags = list(blog.Tag.select())
+                if len(tags) > 1:
+                    (tag, target) = rng.sample(tags, 2)
+                    tag.merge_into(target)
+            assert kept() == counted()
+
+def test_migrate_counts_existing_entries(app):
+    with blog.database.connection_context():
+        for i in range(3):
+            blog.Entry.create(title='Entry %d' % i, content='text', published=i != 0)
+        blog.EntryCount.drop_table()
+        blog.migrate_database()
+        assert kept() == counted()
+        assert blog.Entry.public_count() == 2
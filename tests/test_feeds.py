@@ -0,0 +1,46 @@
+#
+# Feed readers poll with If-None-Match, so the ETag has to change whenever
+# what the feed holds does, including the entries' stored html.
+#
+
+from support import blog
+
+EMBED = 'https://www.youtube.com/watch?v=abc'
+
+
+def create_entry():
+    with blog.database.connection_context():
+        entry = blog.Entry.create(title='Post', content='text\n\n%s\n' % EMBED,
+                                  published=True)
+    return entry
+
+def test_feed_changes_with_the_stored_html(app, client, monkeypatch):
+    create_entry()
+    response = client.get('/feed.xml')
+    assert 'oembed' in response.get_data(as_text=True)
+    etag = response.headers['ETag']
+    assert client.get('/feed.xml', headers={'If-None-Match': etag}).status_code == 304
+
+    # as if `flask oembed refresh` had got a different embed
+    monkeypatch.setattr(blog.Entry, 'render_html', lambda entry: '<p>rendered again</p>')
+    result = app.test_cli_runner().invoke(args=['rerender', '--force'])
+    assert '1 changed' in result.output
+
+    response = client.get('/feed.xml', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'rendered again' in response.get_data(as_text=True)
+
+def test_feed_entries_missing_embeds_are_not_cached(client):
+    entry = create_entry()
+
+    # as if the render job hadn't run yet
+    with blog.database.connection_context():
+        blog.EntryRender.delete().execute()
+        blog.OEmbedResponse.delete().execute()
+
+    assert 'oembed' not in client.get('/feed.xml').get_data(as_text=True)
+    assert not any(key.startswith('feed:') for key in blog.response_cache._data)
+
+    with blog.database.connection_context():
+        blog.render_entry(entry.id)
+    assert 'oembed' in client.get('/feed.xml').get_data(as_text=True)
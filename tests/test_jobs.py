@@ -0,0 +1,32 @@
+#
+# With JOB_WORKERS at 0 jobs run in the request that queued them, but never
+# inside its transaction, which would hold the write lock while rendering
+# and looking up embeds.
+#
+
+import io
+
+from support import blog
+
+
+def test_batch_upload_runs_jobs_after_commit(app, admin, monkeypatch):
+    in_transaction = []
+    render = blog.JOB_HANDLERS['render']
+
+    def spy(entry_id):
+        in_transaction.append(blog.database.in_transaction())
+        render(entry_id)
+
+    monkeypatch.setitem(blog.JOB_HANDLERS, 'render', spy)
+
+    files = [(io.BytesIO(b'---\ntitle: Post %d\ntags: a, b\n---\ntext %d\n' % (i, i)),
+              'post-%d.md' % i) for i in range(3)]
+    response = admin.post(
+        '/upload/batch/', data={'uploaded_files': files},
+        headers={'User-Agent': app.config['UPLOADER_USER_AGENT']})
+    assert response.status_code == 201
+
+    assert in_transaction == [False, False, False]
+    with blog.database.connection_context():
+        assert blog.Job.select().where(blog.Job.status != 'done').count() == 0
+        assert blog.EntryRender.select().count() == 3
@@ -0,0 +1,68 @@
+#
+# The busiest pages have to run a fixed number of queries however many
+# entries there are, a query per entry (for its tags, say) fails these.
+#
+
+import pytest
+
+from support import blog, create_app
+
+# the most queries each page may run, for the logged in user (who also sees
+# the drafts) as well as everyone else
+MAX_QUERIES = {
+    '/': 4,
+    '/?t=common': 4,
+    '/drafts/': 1,
+    '/entry-1/': 3,
+}
+
+
+# the response cache is off, so every request does all of its work
+@pytest.fixture
+def app(tmp_path):
+    yield create_app(str(tmp_path / 'blog.db'), RESPONSE_CACHE_SIZE=0)
+    if not blog.database.is_closed():
+        blog.database.close()
+
+@pytest.fixture(params=[5, 60])
+def entries(request, app):
+    with blog.database.connection_context():
+        for i in range(request.param):
+            entry = blog.Entry.create(
+                title='Entry %d' % i,
+                content='Some *text*\n\n    :::python\n    print(%d)\n' % i,
+                published=i % 5 != 4)
+            entry.add_tags('common', 'tag%d' % (i % 7))
+    return request.param
+
+def count_queries(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return blog.stage_state.queries
+
+@pytest.mark.parametrize('url', [url for url in MAX_QUERIES if url != '/drafts/'])
+def test_public_pages(entries, client, url):
+    assert count_queries(client, url) <= MAX_QUERIES[url]
+
+@pytest.mark.parametrize('url', list(MAX_QUERIES))
+def test_logged_in_pages(entries, admin, url):
+    assert count_queries(admin, url) <= MAX_QUERIES[url]
+
+def test_unknown_tag(entries, client):
+    assert count_queries(client, '/?t=nope') <= MAX_QUERIES['/?t=common']
+
+# the index is the most requested page, the number of entries comes from
+# EntryCount rather than from counting them
+def test_index_counts_nothing(entries, client, admin, monkeypatch):
+    statements = []
+    execute_sql = blog.database.obj.execute_sql
+
+    def capture(sql, *args, **kwargs):
+        statements.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(blog.database.obj, 'execute_sql', capture)
+    for c in (client, admin):
+        assert c.get('/').status_code == 200
+    assert statements
+    assert not [sql for sql in statements if 'COUNT(' in sql.upper()]
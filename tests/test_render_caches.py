@@ -0,0 +1,52 @@
+#
+# The highlighted blocks and oembed responses are kept to their configured
+# sizes by the render job, storing one mustn't step through the whole table.
+#
+
+import datetime
+
+import pytest
+
+from support import blog, create_app
+
+
+@pytest.fixture
+def app(tmp_path):
+    yield create_app(str(tmp_path / 'blog.db'), HIGHLIGHT_CACHE_SIZE=3, OEMBED_CACHE_SIZE=2)
+    if not blog.database.is_closed():
+        blog.database.close()
+
+def test_store_does_not_prune(app, monkeypatch):
+    statements = []
+    execute_sql = blog.database.obj.execute_sql
+
+    def capture(sql, *args, **kwargs):
+        statements.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+
+    monkeypatch.setattr(blog.database.obj, 'execute_sql', capture)
+    with blog.database.connection_context():
+        for i in range(5):
+            blog.HighlightedBlock.store('block-%d' % i, '<pre>%d</pre>' % i)
+            blog.OEmbedResponse.store('response-%d' % i, 'https://example.com/%d' % i, {}, None)
+
+    assert statements
+    assert not [sql for sql in statements if sql.upper().startswith('DELETE')]
+
+def test_render_job_prunes(app):
+    with blog.database.connection_context():
+        start = datetime.datetime.now() - datetime.timedelta(hours=1)
+        for i in range(5):
+            used = start + datetime.timedelta(minutes=i)
+            blog.HighlightedBlock.create(key='block-%d' % i, html='', used_at=used)
+            blog.OEmbedResponse.create(key='response-%d' % i, url='', params='{}',
+                                       fetched_at=used, expires=used)
+
+        entry = blog.Entry.create(title='Entry', content='text', published=True)
+        blog.JOB_HANDLERS['render'](entry.id)
+
+        blocks = [b.key for b in blog.HighlightedBlock.select().order_by(blog.HighlightedBlock.key)]
+        responses = [r.key for r in blog.OEmbedResponse.select().order_by(blog.OEmbedResponse.key)]
+
+    assert blocks == ['block-2', 'block-3', 'block-4']
+    assert responses == ['response-3', 'response-4']
@@ -0,0 +1,55 @@
+#
+# A worker has to start quickly: importing app.py and creating the app must
+# stay within a budget, and must leave the rendering libraries unimported
+# until something is rendered (see get_renderer).
+#
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from support import ROOT
+
+# median milliseconds a fresh interpreter may take, override it with the
+# BLOG_STARTUP_BUDGET environment variable on a slow machine
+STARTUP_BUDGET = float(os.environ.get('BLOG_STARTUP_BUDGET', 1000))
+STARTUP_RUNS = 5
+
+RENDERING_MODULES = ['markdown', 'pygments', 'micawber', 'bs4']
+
+STARTUP = '''
+import sys
+import app
+app.create_app()
+print(json.dumps(sorted(set(sys.argv[1:]) & set(sys.modules))))
+'''
+
+
+def start_app(tmp_path):
+    env = dict(os.environ)
+    path = [ROOT]
+
+    # app.py imports secret.py, which isn't checked in
+    if not os.path.exists(os.path.join(ROOT, 'secret.py')):
+        with open(os.path.join(str(tmp_path), 'secret.py'), 'w') as f:
+            f.write("SECRET_KEY = b'tests'\n")
+        path.append(str(tmp_path))
+    env['PYTHONPATH'] = os.pathsep.join(path + [env.get('PYTHONPATH', '')])
+
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', 'import json\n' + STARTUP] + RENDERING_MODULES,
+        cwd=str(tmp_path), env=env, check=True, stdout=subprocess.PIPE).stdout
+    return ((time.perf_counter() - start) * 1000, json.loads(output))
+
+def test_startup_is_within_budget(tmp_path):
+    timings = []
+    for _ in range(STARTUP_RUNS):
+        (elapsed, imported) = start_app(tmp_path)
+        timings.append(elapsed)
+        assert imported == []
+
+    assert statistics.median(timings) < STARTUP_BUDGET
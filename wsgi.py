@@ -0,0 +1,12 @@
+#
+# The production entry point, point the WSGI server at `application`, e.g.
+#   gunicorn wsgi:application
+# or import it from the WSGI configuration file on PythonAnywhere.
+#
+# Run `flask migrate` (with FLASK_APP=wsgi) before starting it the first time
+# and after every upgrade, the app doesn't create or change tables itself.
+#
+
+from app import create_app
+
+application = create_app()